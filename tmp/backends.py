@@ -0,0 +1,126 @@
+"""Inference backends for the batch submission pipeline.
+
+Both backends take a list of per-image (N, C, H, W) tile tensors plus the
+rice type index of every image and return the *raw* model outputs as numpy
+arrays, counts (B, 9) and measures (B, 6).  De-normalisation, the rice-type
+zero constraints and rounding stay in ``submit.postprocess`` so torch and
+ONNX Runtime results go through exactly the same tail.
+
+    torch        eager UltimateSpecialist (checkpoint), supports the fused /
+                 skip-zero-heads / feature-cache options
+    onnxruntime  MobileWrapper graph from convert_onnx.py, one long-lived
+                 session with IOBinding over preallocated buffers
+"""
+
+import json
+
+import numpy as np
+import torch
+
+import profiling
+from submit import Config, build_meta
+
+# convert_onnx.py --ort-artifacts: graphs already optimized offline, opened without re-optimizing
+PREOPTIMIZED_SUFFIXES = ('.opt.onnx', '.ort')
+
+
+class TorchBackend:
+    name = 'torch'
+
+    def __init__(self, model, m_stats, skip_zero_heads=False, cache=None, threads=0, tile_chunk=0, runner=None,
+                 tile_filter=None):
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.model = model
+        self.m_stats = m_stats
+        self.skip_zero_heads = skip_zero_heads
+        self.cache = cache
+        self.tile_chunk = tile_chunk
+        self.runner = runner   # fast_cpu.FastCPUModel wrapping ``model``, or None for the eager FP32 path
+        self.tile_filter = tile_filter   # tile_filter.TileFilter: skip background tiles
+        self.tile_size = Config.TILE_SIZE
+
+    def predict(self, tiles, rice_types, keys=None, reload=None):
+        """Raw (counts, measures) for one batch; ``keys``/``reload`` are used with the feature cache."""
+        meta = build_meta(rice_types).to(Config.DEVICE)
+        with torch.no_grad():
+            if self.cache is not None:
+                from feature_cache import forward_cached
+                p_c, p_m = forward_cached(self.model, self.cache, keys, tiles, meta, reload,
+                                          skip_zero_heads=self.skip_zero_heads)
+            else:
+                # (B, N, C, H, W): all tiles of every image go through the backbone in one call
+                with profiling.stage('h2d', images=len(tiles)):
+                    processed = torch.stack(tiles).to(Config.DEVICE)
+                tile_mask = None
+                if self.tile_filter is not None:
+                    with profiling.stage('tile_filter', images=len(tiles)):
+                        tile_mask = self.tile_filter.mask(processed)
+                if self.runner is not None:
+                    p_c, p_m = self.runner(processed, meta, tile_mask=tile_mask)
+                else:
+                    p_c, p_m = self.model(processed, meta, skip_zero_heads=self.skip_zero_heads,
+                                          tile_chunk=self.tile_chunk, tile_mask=tile_mask)
+        return p_c.cpu().numpy(), p_m.cpu().numpy()
+
+
+class OrtBackend:
+    """ONNX Runtime session over the exported MobileWrapper graph (one image per run).
+
+    Inputs and outputs are bound once to numpy buffers; every image is copied
+    into the same ``tiles`` buffer and the outputs land in the same result
+    buffers, so nothing is allocated per image.
+    """
+
+    name = 'onnxruntime'
+
+    def __init__(self, onnx_path, intra_op_threads=0, inter_op_threads=0, tile_size=None):
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = (ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+                                         if onnx_path.endswith(PREOPTIMIZED_SUFFIXES)
+                                         else ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        opts.intra_op_num_threads = intra_op_threads
+        opts.inter_op_num_threads = inter_op_threads
+        opts.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1
+                               else ort.ExecutionMode.ORT_SEQUENTIAL)
+        self.session = ort.InferenceSession(onnx_path, opts, providers=['CPUExecutionProvider'])
+
+        tiles_shape = self.session.get_inputs()[0].shape   # ['n_tiles', 3, T, T] or [..., 'tile_h', 'tile_w']
+        if isinstance(tiles_shape[-1], int):
+            if tile_size not in (None, tiles_shape[-1]):
+                raise ValueError(f"{onnx_path} is fixed at {tiles_shape[-1]}px tiles, not {tile_size}")
+            self.tile_size = tiles_shape[-1]
+        else:
+            # Dynamic H/W export (convert_onnx.export(dynamic_hw=True))
+            self.tile_size = tile_size or Config.TILE_SIZE
+        self._tiles = np.zeros((Config.N_TILES, 3, self.tile_size, self.tile_size), dtype=np.float32)
+        self._meta = np.zeros((1, 3), dtype=np.float32)
+        self._counts = np.zeros((1, Config.N_COUNTS), dtype=np.float32)
+        self._measures = np.zeros((1, len(Config.MEASURE_COLS)), dtype=np.float32)
+
+        self.binding = self.session.io_binding()
+        for name, buf in (('tiles', self._tiles), ('meta', self._meta)):
+            self.binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(buf))
+        for name, buf in (('counts', self._counts), ('measures', self._measures)):
+            self.binding.bind_ortvalue_output(name, ort.OrtValue.ortvalue_from_numpy(buf))
+
+        # convert_onnx.py stores the checkpoint's m_stats in the model metadata
+        meta_map = self.session.get_modelmeta().custom_metadata_map
+        self.m_stats = ([np.asarray(v, dtype=np.float64) for v in json.loads(meta_map['m_stats'])]
+                        if 'm_stats' in meta_map else None)
+
+    def predict(self, tiles, rice_types, keys=None, reload=None):
+        counts = np.empty((len(tiles), Config.N_COUNTS), dtype=np.float32)
+        measures = np.empty((len(tiles), len(Config.MEASURE_COLS)), dtype=np.float32)
+        for i, (image_tiles, rice_type) in enumerate(zip(tiles, rice_types)):
+            with profiling.stage('h2d'):
+                np.copyto(self._tiles, image_tiles.numpy() if isinstance(image_tiles, torch.Tensor) else image_tiles)
+                self._meta.fill(0.0)
+                self._meta[0, rice_type] = 1.0
+            with profiling.stage('ort_run'):
+                self.session.run_with_iobinding(self.binding)
+            counts[i] = self._counts[0]
+            measures[i] = self._measures[0]
+        return counts, measures
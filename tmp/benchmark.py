@@ -0,0 +1,282 @@
+"""Reproducible latency / throughput / memory benchmark for the inference stack.
+
+Every case of the grid below runs in a fresh (spawned) process, so model
+load time and peak RSS are measured per case and earlier cases cannot warm
+caches or inflate memory for later ones.
+
+    backend     torch (eager), ort-fp32, ort-int8 (dynamic INT8)
+    tile size   e.g. 224 (mobile export) vs 512 (Config.TILE_SIZE)
+    tile count  tiles per image (48 = 8x6 grid)
+    batch size  images per timed iteration
+    threads     intra-op threads (torch.set_num_threads / ORT intra_op_num_threads)
+
+Usage:
+    python benchmark.py --tiny                                 # random convnext_atto, no checkpoint needed
+    python benchmark.py --tile-sizes 224,512 --threads 1,4 --output bench.json
+    python benchmark.py --tiny --baseline bench_baseline.json  # exit 1 on regression
+
+The ORT backends run the MobileWrapper graph one image at a time (as in
+submit.py), so a batch of B images is B session runs per iteration.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TINY_MODEL = 'convnext_atto'
+BACKENDS = ('torch', 'ort-fp32', 'ort-int8')
+CASE_KEYS = ('backend', 'tile_size', 'n_tiles', 'batch_size', 'threads')
+
+
+def build_model(model_name, checkpoint=None):
+    """UltimateSpecialist from ``checkpoint``, or randomly initialised (seeded) when None."""
+    import torch
+    from submit import UltimateSpecialist
+
+    torch.manual_seed(0)
+    model = UltimateSpecialist(model_name)
+    if checkpoint:
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu', weights_only=False)['model'])
+    return model.eval()
+
+
+def prepare_onnx(model_name, checkpoint, tile_sizes, backends, workdir):
+    """Export (and quantize) one ONNX graph per tile size needed by the ORT backends."""
+    import convert_onnx
+
+    paths = {}
+    for tile in tile_sizes:
+        if 'ort-fp32' not in backends and 'ort-int8' not in backends:
+            break
+        fp32 = convert_onnx.export(tile=tile, out_path=os.path.join(workdir, f'model_{tile}.onnx'),
+                                   base=build_model(model_name, checkpoint))
+        paths[('ort-fp32', tile)] = fp32
+        if 'ort-int8' in backends:
+            paths[('ort-int8', tile)] = convert_onnx.quantize_int8(
+                fp32, os.path.join(workdir, f'model_{tile}_int8.onnx'))
+    return paths
+
+
+def _peak_rss_mb():
+    # VmHWM is reset by exec; ru_maxrss would still include the parent's peak from before the spawn
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0   # KiB on Linux
+
+
+def case_tiles(case, tile_store=None):
+    """(B, N, 3, T, T) inputs: real tiles when ``tile_store`` matches the case, else seeded noise."""
+    b, n, t = case['batch_size'], case['n_tiles'], case['tile_size']
+    if tile_store:
+        from tile_store import TileStore
+        store = TileStore(tile_store)
+        if store.tile_size == t and store.grid[0] * store.grid[1] == n:
+            return np.stack([store.tiles(store.ids[i % len(store)]).numpy() for i in range(b)]), 'store'
+    return np.random.default_rng(0).standard_normal((b, n, 3, t, t), dtype=np.float32), 'random'
+
+
+def run_case(case, model_name, checkpoint, onnx_path, iters, warmup, tile_store=None):
+    """Run one benchmark case in the current process and return its metrics."""
+    b = case['batch_size']
+    tiles, inputs = case_tiles(case, tile_store)
+    meta = np.zeros((b, 3), dtype=np.float32)
+    meta[np.arange(b), np.arange(b) % 3] = 1.0
+
+    t0 = time.perf_counter()
+    if case['backend'] == 'torch':
+        import torch
+        import submit  # noqa: F401
+        import timm  # noqa: F401  (submit imports it lazily in UltimateSpecialist; keep it out of load_ms)
+        import_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        torch.set_num_threads(case['threads'])
+        model = build_model(model_name, checkpoint)
+        x, m = torch.from_numpy(tiles), torch.from_numpy(meta)
+
+        def step():
+            with torch.no_grad():
+                model(x, m)
+    else:
+        import onnxruntime as ort
+        import_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = case['threads']
+        sess = ort.InferenceSession(onnx_path, opts, providers=['CPUExecutionProvider'])
+
+        def step():
+            for i in range(b):
+                sess.run(None, {'tiles': tiles[i], 'meta': meta[i:i + 1]})
+    load_s = time.perf_counter() - t0
+
+    for _ in range(warmup):
+        step()
+    times = []
+    for _ in range(iters):
+        t1 = time.perf_counter()
+        step()
+        times.append(time.perf_counter() - t1)
+
+    ms = np.asarray(times) * 1e3
+    return dict(case,
+                inputs=inputs,
+                import_ms=import_s * 1e3,
+                load_ms=load_s * 1e3,
+                p50_ms=float(np.percentile(ms, 50)),
+                p95_ms=float(np.percentile(ms, 95)),
+                p99_ms=float(np.percentile(ms, 99)),
+                mean_ms=float(ms.mean()),
+                images_per_s=float(b / (ms.mean() / 1e3)),
+                peak_rss_mb=_peak_rss_mb())
+
+
+def _case_worker(args, queue):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:   # report instead of hanging the parent
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def run_isolated(case, *args):
+    """Run ``run_case`` in a spawned child so load time and peak RSS are per case."""
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_case_worker, args=((case, *args), queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    if 'error' in result:
+        raise RuntimeError(f"case {case} failed: {result['error']}")
+    return result
+
+
+def case_id(result):
+    return tuple(result[k] for k in CASE_KEYS)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Return the cases whose p50 latency or throughput regressed by more than ``tolerance``."""
+    base = {case_id(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        ref = base.get(case_id(r))
+        if ref is None:
+            continue
+        if r['p50_ms'] > ref['p50_ms'] * (1 + tolerance) or r['images_per_s'] < ref['images_per_s'] * (1 - tolerance):
+            regressions.append((r, ref))
+    return regressions
+
+
+def print_table(results):
+    print(f"{'backend':<9} {'tile':>4} {'N':>3} {'B':>3} {'thr':>3}  {'import':>7} {'load':>7} {'p50':>8} {'p95':>8} "
+          f"{'p99':>8} {'img/s':>7} {'rss MB':>7}")
+    for r in results:
+        print(f"{r['backend']:<9} {r['tile_size']:>4} {r['n_tiles']:>3} {r['batch_size']:>3} {r['threads']:>3}  "
+              f"{r['import_ms']:>5.0f}ms {r['load_ms']:>5.0f}ms {r['p50_ms']:>6.1f}ms {r['p95_ms']:>6.1f}ms {r['p99_ms']:>6.1f}ms "
+              f"{r['images_per_s']:>7.2f} {r['peak_rss_mb']:>7.0f}")
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def parse_args(argv=None):
+    from submit import Config
+
+    parser = argparse.ArgumentParser(description='Benchmark the inference stack over a parameter grid')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help=f'subset of {",".join(BACKENDS)}')
+    parser.add_argument('--tile-sizes', type=_int_list, default=[224])
+    parser.add_argument('--tile-counts', type=_int_list, default=[Config.N_TILES])
+    parser.add_argument('--batch-sizes', type=_int_list, default=[1])
+    parser.add_argument('--threads', type=_int_list, default=[os.cpu_count() or 1])
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--tiny', action='store_true',
+                        help=f'randomly initialised {TINY_MODEL} backbone, no checkpoint needed')
+    parser.add_argument('--model-name', default=Config.MODEL_NAME)
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT)
+    parser.add_argument('--tile-store', help='tile_store.py array; cases with its tile size and count use these '
+                                             'real tiles instead of random inputs')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON from an earlier --output run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed relative slowdown before a case counts as a regression')
+    args = parser.parse_args(argv)
+    args.backends = [b for b in args.backends.split(',') if b]
+    unknown = set(args.backends) - set(BACKENDS)
+    if unknown:
+        parser.error(f'unknown backends: {sorted(unknown)}')
+    if args.tiny:
+        args.model_name, args.checkpoint = TINY_MODEL, None
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as workdir:
+        onnx_paths = prepare_onnx(args.model_name, args.checkpoint, args.tile_sizes, args.backends, workdir)
+        results = []
+        for backend, tile, n, b, threads in itertools.product(
+                args.backends, args.tile_sizes, args.tile_counts, args.batch_sizes, args.threads):
+            case = dict(backend=backend, tile_size=tile, n_tiles=n, batch_size=b, threads=threads)
+            print(f"running {case} …", flush=True)
+            results.append(run_isolated(case, args.model_name, args.checkpoint,
+                                        onnx_paths.get((backend, tile)), args.iters, args.warmup, args.tile_store))
+
+    print()
+    print_table(results)
+    report = {
+        'model': args.model_name,
+        'checkpoint': args.checkpoint,
+        'iters': args.iters,
+        'warmup': args.warmup,
+        'env': {'python': platform.python_version(), 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(), 'versions': _versions()},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for r, ref in regressions:
+            print(f"REGRESSION {case_id(r)}: p50 {ref['p50_ms']:.1f} → {r['p50_ms']:.1f} ms, "
+                  f"{ref['images_per_s']:.2f} → {r['images_per_s']:.2f} img/s")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+def _versions():
+    versions = {}
+    for mod in ('torch', 'timm', 'onnxruntime', 'numpy'):
+        try:
+            versions[mod] = __import__(mod).__version__
+        except ImportError:
+            pass
+    return versions
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
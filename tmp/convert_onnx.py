@@ -2,11 +2,26 @@
 
 Usage:
     python convert_onnx.py            # FP32 + optional INT8 quantization
+    python convert_onnx.py --quant static --calib-dir Data/images/images \
+        --holdout-dir Data/holdout    # static QDQ INT8 calibrated on real tiles
+    python convert_onnx.py --ort-artifacts                    # + pre-optimized ORT artifacts
+    python convert_onnx.py --ort-artifacts model_mobile.onnx  # artifacts for an existing model only
 
 Output:
     model_mobile.onnx      (~200 MB FP32)
     model_mobile_int8.onnx (~50 MB INT8, 2-4× faster on CPU)
 
+Pre-optimized artifacts (--ort-artifacts), so sessions skip ORT's graph
+optimizations at every process start (loaded with ORT_DISABLE_ALL):
+    model_mobile.opt.onnx (+ .opt.onnx.data)  optimized graph, weights in an
+                                              external file ORT can mmap
+    model_mobile.ort                          ORT format, for onnxruntime-mobile
+The default level (all) includes the NCHWc layout transforms for this CPU,
+so those artifacts only belong on machines like the one that wrote them.
+``--ort-opt-level extended`` writes portable artifacts (e.g. for the app);
+opened without optimizations they miss the CPU layout transforms, which the
+steady-state column of the session-start report shows.
+
 Fix notes vs previous attempt:
     - PyTorch >=2.5 defaults to the dynamo exporter which silently produces a
       broken 1.7 MB graph for this model.  We force dynamo=False (TorchScript
@@ -15,19 +30,20 @@ Fix notes vs previous attempt:
       onnxscript's version converter.
 """
 
-import os, sys, time
+import os, sys, time, json, argparse, fnmatch
 import torch
 import torch.nn as nn
 import numpy as np
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from run import UltimateSpecialist, Config
+from submit import UltimateSpecialist, Config
+from backends import PREOPTIMIZED_SUFFIXES
 
 MOBILE_TILE = 224
 SCRIPT_DIR  = os.path.dirname(os.path.abspath(__file__))
 ONNX_OUT    = os.path.join(SCRIPT_DIR, "model_mobile.onnx")
 ONNX_INT8   = os.path.join(SCRIPT_DIR, "model_mobile_int8.onnx")
-
+ONNX_QDQ    = os.path.join(SCRIPT_DIR, "model_mobile_int8_qdq.onnx")
 
 class MobileWrapper(nn.Module):
     """Simplify I/O for ONNX export: flat tiles (N,C,H,W) instead of (B,N,C,H,W)."""
@@ -43,30 +59,46 @@ class MobileWrapper(nn.Module):
         return counts, measures  # (1, 9), (1, 6)
 
 
-def export() -> str:
-    print("Loading checkpoint …")
-    ckpt = torch.load(Config.CHECKPOINT, map_location="cpu", weights_only=False)
-    base = UltimateSpecialist(Config.MODEL_NAME)
-    base.load_state_dict(ckpt["model"])
+def export(tile: int = None, out_path: str = None, base: UltimateSpecialist = None, m_stats=None,
+           dynamic_hw: bool = False, dummy_tiles: int = None) -> str:
+    """Export ``base`` (default: the checkpoint model) at a fixed tile size; returns the ONNX path.
+
+    ``dynamic_hw`` also makes the tile height/width dynamic axes; the graph is
+    traced at ``tile`` and is only exact for sizes that are multiples of 32.
+    ``dummy_tiles`` is the number of tiles traced (n_tiles is dynamic either
+    way); fewer than 48 keeps large tile sizes in memory.
+    """
+    tile = tile or MOBILE_TILE
+    out_path = out_path or ONNX_OUT
+    from_checkpoint = base is None
+    if from_checkpoint:
+        print("Loading checkpoint …")
+        ckpt = torch.load(Config.CHECKPOINT, map_location="cpu", weights_only=False)
+        base = UltimateSpecialist(Config.MODEL_NAME)
+        base.load_state_dict(ckpt["model"])
+        m_stats = ckpt["m_stats"]
     base.eval()
 
     model = MobileWrapper(base).eval()
 
-    N = Config.N_TILES  # 48 tiles
-    dummy_tiles = torch.randn(N, 3, MOBILE_TILE, MOBILE_TILE)
+    N = dummy_tiles or Config.N_TILES  # 48 tiles
+    dummy_tiles = torch.randn(N, 3, tile, tile)
     dummy_meta = torch.zeros(1, 3)
     dummy_meta[0, 0] = 1.0  # Paddy
 
-    print(f"Exporting ONNX (opset=14, dynamo=False, tile={MOBILE_TILE}×{MOBILE_TILE}) …")
+    dynamic_axes = {"tiles": {0: "n_tiles"}, "meta": {0: "batch"}}
+    if dynamic_hw:
+        dynamic_axes["tiles"].update({2: "tile_h", 3: "tile_w"})
+    print(f"Exporting ONNX (opset=14, dynamo=False, tile={'dynamic' if dynamic_hw else f'{tile}×{tile}'}) …")
     t0 = time.time()
     with torch.no_grad():
         torch.onnx.export(
             model,
             (dummy_tiles, dummy_meta),
-            ONNX_OUT,
+            out_path,
             input_names=["tiles", "meta"],
             output_names=["counts", "measures"],
-            dynamic_axes={"tiles": {0: "n_tiles"}, "meta": {0: "batch"}},
+            dynamic_axes=dynamic_axes,
             opset_version=14,       # 14 = stable; avoids Resize adapter bug in opset 17
             do_constant_folding=True,
             dynamo=False,           # CRITICAL: force TorchScript tracer (not dynamo)
@@ -74,12 +106,28 @@ def export() -> str:
                                     # a broken 1.7 MB graph for this model
         )
     elapsed = time.time() - t0
-    mb = os.path.getsize(ONNX_OUT) / 1e6
-    print(f"  ✓ saved → {ONNX_OUT}  ({mb:.1f} MB, {elapsed:.1f}s)")
-    if mb < 50:
+    embed_metadata(out_path, m_stats, "dynamic" if dynamic_hw else tile)
+    mb = os.path.getsize(out_path) / 1e6
+    print(f"  ✓ saved → {out_path}  ({mb:.1f} MB, {elapsed:.1f}s)")
+    if from_checkpoint and mb < 50:
         print("  ⚠ WARNING: file is suspiciously small — backbone may not have been captured.")
         print("    Check that checkpoint contains backbone weights.")
-    return ONNX_OUT
+    return out_path
+
+
+def embed_metadata(path: str, m_stats, tile_size):
+    """Store m_stats + tile size in the ONNX metadata so ORT consumers need no checkpoint."""
+    try:
+        import onnx
+    except ImportError:
+        print("Install onnx to embed m_stats metadata: pip install onnx")
+        return
+    m = onnx.load(path)
+    props = {"tile_size": str(tile_size), "grid": f"{Config.GRID_ROWS}x{Config.GRID_COLS}"}
+    if m_stats is not None:
+        props["m_stats"] = json.dumps([np.asarray(s, dtype=np.float64).tolist() for s in m_stats])
+    onnx.helper.set_model_props(m, props)
+    onnx.save(m, path)
 
 
 def verify(path: str):
@@ -113,6 +161,226 @@ def quantize_int8(fp32_path: str = ONNX_OUT, out_path: str = ONNX_INT8) -> str:
     return out_path
 
 
+def list_images(folder: str, limit: int = None, skip: set = frozenset()) -> list:
+    """Sorted .png/.jpg paths in ``folder`` (deterministic calibration / hold-out split)."""
+    names = sorted(f for f in os.listdir(folder) if f.lower().endswith((".png", ".jpg", ".jpeg")))
+    paths = [os.path.join(folder, f) for f in names if os.path.join(folder, f) not in skip]
+    return paths[:limit] if limit else paths
+
+
+def image_feeds(paths: list, tile: int = None, store=None):
+    """Yield ``{"tiles", "meta"}`` feeds built with the submission pipeline (get_tiles + transform).
+
+    Rice types cycle Paddy → White → Brown so every meta branch sees data.
+    With a tile_store.TileStore built at this tile size, stored images skip
+    decode and resize.
+    """
+    import albumentations as A
+    from albumentations.pytorch import ToTensorV2
+    from PIL import Image
+    from submit import get_tiles
+
+    tile = tile or MOBILE_TILE
+    if store is not None:
+        store.check(tile, Config.GRID_ROWS, Config.GRID_COLS, "reference")
+    transform = A.Compose([A.Resize(tile, tile), A.Normalize(), ToTensorV2()])
+    for i, path in enumerate(paths):
+        image_id = os.path.splitext(os.path.basename(path))[0]
+        if store is not None and store.is_fresh(image_id, path):
+            tiles = store.tiles(image_id).numpy()
+        else:
+            image = np.array(Image.open(path).convert("RGB"))
+            tiles = torch.stack([transform(image=t)["image"] for t in get_tiles(image)]).numpy()
+        meta = np.zeros((1, 3), dtype=np.float32)
+        meta[0, i % 3] = 1.0
+        yield {"tiles": tiles, "meta": meta}
+
+
+def resolve_nodes(path: str, patterns: list) -> list:
+    """Expand node-name glob patterns (e.g. ``/m/count_heads*``) against the graph."""
+    if not patterns:
+        return []
+    import onnx
+    names = [n.name for n in onnx.load(path, load_external_data=False).graph.node]
+    return sorted({n for n in names for p in patterns if fnmatch.fnmatchcase(n, p)})
+
+
+def quantize_static_int8(fp32_path: str, out_path: str, calib_paths: list, method: str = "minmax",
+                         per_channel: bool = True, exclude: list = (), store=None) -> str:
+    """Static QDQ INT8: weights *and* activations quantized, so ConvNeXt convs run in INT8 too."""
+    try:
+        from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat,
+                                              QuantType, quantize_static)
+    except ImportError:
+        print("Install onnxruntime to quantize: pip install onnxruntime")
+        return fp32_path
+
+    # Defined here so importing convert_onnx (benchmark.py, resolution_ladder.py) skips onnx + quantization
+    class TileCalibrationReader(CalibrationDataReader):
+        """Streams real calibration tiles one image at a time (nothing is preloaded)."""
+
+        def __init__(self, paths: list, tile: int = None, store=None):
+            self.paths = paths
+            self.tile = tile
+            self.store = store
+            self._feeds = image_feeds(paths, tile, store)
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+        def rewind(self):
+            self._feeds = image_feeds(self.paths, self.tile, self.store)
+
+    methods = {"minmax": CalibrationMethod.MinMax, "entropy": CalibrationMethod.Entropy,
+               "percentile": CalibrationMethod.Percentile}
+    nodes_to_exclude = resolve_nodes(fp32_path, exclude)
+    print(f"Quantizing to INT8 (static QDQ, {method}, per_channel={per_channel}, "
+          f"{len(calib_paths)} calibration images, {len(nodes_to_exclude)} nodes excluded) …")
+    t0 = time.time()
+    quantize_static(
+        fp32_path,
+        out_path,
+        TileCalibrationReader(calib_paths, store=store),
+        quant_format=QuantFormat.QDQ,
+        per_channel=per_channel,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_exclude=nodes_to_exclude,
+        calibrate_method=methods[method],
+    )
+    mb = os.path.getsize(out_path) / 1e6
+    print(f"  ✓ saved → {out_path}  ({mb:.1f} MB, {time.time()-t0:.1f}s)")
+    return out_path
+
+
+def compare_quantized(fp32_path: str, int8_path: str, paths: list, store=None) -> dict:
+    """Latency and count/measure error of an INT8 model against its FP32 source on held-out images."""
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sessions = {label: ort.InferenceSession(p, opts, providers=["CPUExecutionProvider"])
+                for label, p in (("fp32", fp32_path), ("int8", int8_path))}
+    meta_map = sessions["fp32"].get_modelmeta().custom_metadata_map
+    m_std = np.asarray(json.loads(meta_map["m_stats"])[1]) if "m_stats" in meta_map else np.ones(6)
+
+    times = {label: [] for label in sessions}
+    count_err, measure_err = [], []
+    for feeds in image_feeds(paths, store=store):
+        outs = {}
+        for label, sess in sessions.items():
+            t = time.perf_counter()
+            outs[label] = sess.run(None, feeds)
+            times[label].append(time.perf_counter() - t)
+        # Compare in output units: counts / SCALE, measures de-normalised with m_stats std
+        count_err.append(np.abs(outs["int8"][0] - outs["fp32"][0])[0] / Config.SCALE)
+        measure_err.append(np.abs(outs["int8"][1] - outs["fp32"][1])[0] * m_std)
+
+    count_mae, measure_mae = np.mean(count_err, axis=0), np.mean(measure_err, axis=0)
+    print(f"\n── INT8 vs FP32 on {len(paths)} held-out images ──")
+    for label in sessions:
+        print(f"{label:<6} latency  mean={np.mean(times[label])*1e3:.0f}ms  p50={np.median(times[label])*1e3:.0f}ms")
+    print(f"{'column':<22} {'MAE vs FP32':>12}")
+    for col, err in zip(Config.COUNT_COLS + Config.MEASURE_COLS, np.concatenate([count_mae, measure_mae])):
+        print(f"{col:<22} {err:>12.4f}")
+    return {"count_mae": count_mae, "measure_mae": measure_mae,
+            "fp32_ms": np.mean(times["fp32"]) * 1e3, "int8_ms": np.mean(times["int8"]) * 1e3}
+
+
+def artifact_paths(onnx_path: str) -> dict:
+    stem = os.path.splitext(onnx_path)[0]
+    return {"optimized": stem + PREOPTIMIZED_SUFFIXES[0], "ort": stem + PREOPTIMIZED_SUFFIXES[1]}
+
+
+def write_ort_artifacts(onnx_path: str, level: str = "all") -> dict:
+    """Run ORT's graph optimizations once, offline, and save the result as .opt.onnx (+ .data) and .ort."""
+    import onnxruntime as ort
+
+    levels = {"basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+              "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+              "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+    paths = artifact_paths(onnx_path)
+    for kind, out in paths.items():
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = levels[level]
+        opts.optimized_model_filepath = out
+        if kind == "ort":
+            opts.add_session_config_entry("session.save_model_format", "ORT")
+        else:
+            # Large initializers go to <out>.data (relative to the model); small ones stay inline
+            opts.add_session_config_entry("session.optimized_model_external_initializers_file_name",
+                                          os.path.basename(out) + ".data")
+            opts.add_session_config_entry("session.optimized_model_external_initializers_min_size_in_bytes",
+                                          "1024")
+        t0 = time.time()
+        ort.InferenceSession(onnx_path, opts, providers=["CPUExecutionProvider"])
+        print(f"  ✓ saved → {out}  ({_artifact_mb(out):.1f} MB, {level}, {time.time()-t0:.1f}s)")
+    return paths
+
+
+def _artifact_mb(path: str) -> float:
+    data = path + ".data"
+    return (os.path.getsize(path) + (os.path.getsize(data) if os.path.exists(data) else 0)) / 1e6
+
+
+_SESSION_START = r'''
+import json, time
+import numpy as np
+import onnxruntime as ort
+opts = ort.SessionOptions()
+opts.graph_optimization_level = ort.GraphOptimizationLevel.{level}
+t0 = time.perf_counter()
+sess = ort.InferenceSession({path!r}, opts, providers=["CPUExecutionProvider"])
+t1 = time.perf_counter()
+shape = [{n_tiles} if isinstance(d, str) else d for d in sess.get_inputs()[0].shape]
+feeds = {{"tiles": np.random.default_rng(0).standard_normal(shape, dtype=np.float32),
+          "meta": np.array([[1.0, 0.0, 0.0]], dtype=np.float32)}}
+sess.run(None, feeds)
+t2 = time.perf_counter()
+for _ in range({runs}):
+    sess.run(None, feeds)
+t3 = time.perf_counter()
+rss = [int(l.split()[1]) for l in open("/proc/self/status") if l.startswith("VmRSS")][0]
+print(json.dumps({{"create_ms": (t1 - t0) * 1e3, "first_ms": (t2 - t1) * 1e3,
+                  "steady_ms": (t3 - t2) * 1e3 / max({runs}, 1), "rss_mb": rss / 1024}}))
+'''
+
+
+def session_start(path: str, runs: int = 3) -> dict:
+    """Session-create, first-inference and steady-state latency of ``path`` in a fresh interpreter.
+
+    Pre-optimized artifacts are opened with ORT_DISABLE_ALL, like OrtBackend does.
+    """
+    import subprocess
+
+    level = "ORT_DISABLE_ALL" if path.endswith(PREOPTIMIZED_SUFFIXES) else "ORT_ENABLE_ALL"
+    code = _SESSION_START.format(level=level, path=path, n_tiles=Config.N_TILES, runs=runs)
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def session_start_report(paths: list, repeats: int = 3) -> dict:
+    """Print cold session-create / first-inference time per model file (best of ``repeats`` processes)."""
+    print(f"\n── Session start (fresh process, best of {repeats}) ──")
+    print(f"{'artifact':<36} {'MB':>7} {'create ms':>10} {'first run ms':>13} {'steady ms':>10} {'RSS MB':>8}")
+    results = {}
+    for path in paths:
+        r = min((session_start(path) for _ in range(repeats)), key=lambda r: r["create_ms"] + r["first_ms"])
+        results[path] = r
+        print(f"{os.path.basename(path):<36} {_artifact_mb(path):>7.1f} {r['create_ms']:>10.0f} "
+              f"{r['first_ms']:>13.0f} {r['steady_ms']:>10.0f} {r['rss_mb']:>8.0f}")
+    return results
+
+
+def ort_artifacts(onnx_paths: list, level: str = "all") -> dict:
+    """Write the pre-optimized artifacts of every model in ``onnx_paths`` and compare their cold start."""
+    print(f"Writing pre-optimized ORT artifacts ({level}) …")
+    compared = []
+    for path in onnx_paths:
+        compared += [path] + list(write_ort_artifacts(path, level).values())
+    return session_start_report(compared)
+
+
 def _run_ort_benchmark(path: str, label: str, runs: int = 5) -> float:
     import onnxruntime as ort
     opts = ort.SessionOptions()
@@ -172,20 +440,69 @@ def pytorch_benchmark(runs: int = 5) -> float:
     return avg_ms
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export UltimateSpecialist to ONNX and quantize it")
+    parser.add_argument("--quant", choices=["dynamic", "static", "none"], default="dynamic",
+                        help="dynamic: MatMul/Linear weights only; static: QDQ calibrated on real tiles")
+    parser.add_argument("--calib-dir", default=Config.IMAGE_DIR, help="images used for static calibration")
+    parser.add_argument("--calib-count", type=int, default=64)
+    parser.add_argument("--calib-method", choices=["minmax", "entropy", "percentile"], default="minmax")
+    parser.add_argument("--no-per-channel", dest="per_channel", action="store_false",
+                        help="per-tensor instead of per-channel weight scales")
+    parser.add_argument("--exclude-nodes", default="",
+                        help="comma-separated node names / glob patterns kept in FP32, e.g. '/m/measure_head/*'")
+    parser.add_argument("--holdout-dir", help="compare INT8 vs FP32 latency and error on these images")
+    parser.add_argument("--holdout-count", type=int, default=32)
+    parser.add_argument("--tile-store", help=f"tile_store.py array built at --tile-size {MOBILE_TILE}; calibration "
+                                             "and hold-out images found in it are not decoded again")
+    parser.add_argument("--ort-artifacts", nargs="?", const="", metavar="ONNX",
+                        help="also write pre-optimized .opt.onnx/.ort artifacts and compare session start; "
+                             "with a path, only do that for an existing model")
+    parser.add_argument("--ort-opt-level", choices=["basic", "extended", "all"], default="all",
+                        help="optimization level baked into the artifacts (all: this CPU only, "
+                             "extended: portable)")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.ort_artifacts:
+        ort_artifacts([args.ort_artifacts], args.ort_opt_level)
+        sys.exit(0)
+    store = None
+    if args.tile_store:
+        from tile_store import TileStore
+        store = TileStore(args.tile_store)
     fp32_path = export()
     verify(fp32_path)
 
     # INT8 quantization
-    int8_path = quantize_int8(fp32_path)
+    int8_path = None
+    if args.quant == "dynamic":
+        int8_path = quantize_int8(fp32_path)
+    elif args.quant == "static":
+        calib = list_images(args.calib_dir, args.calib_count)
+        int8_path = quantize_static_int8(fp32_path, ONNX_QDQ, calib, method=args.calib_method,
+                                         per_channel=args.per_channel,
+                                         exclude=[p for p in args.exclude_nodes.split(",") if p], store=store)
 
     print(f"\n── Speed Comparison ({MOBILE_TILE}×{MOBILE_TILE} tiles × {Config.N_TILES}, CPU) ──")
     pt_ms   = pytorch_benchmark()
     fp32_ms = benchmark(fp32_path)
-    int8_ms = _run_ort_benchmark(int8_path, "ONNX INT8 (CPU)") if os.path.exists(int8_path) else None
+    int8_ms = (_run_ort_benchmark(int8_path, f"ONNX INT8 {args.quant} (CPU)")
+               if int8_path and os.path.exists(int8_path) else None)
 
     print()
     if fp32_ms:
         print(f"  ONNX FP32 speedup: {pt_ms/fp32_ms:.2f}×")
     if int8_ms:
         print(f"  ONNX INT8 speedup: {pt_ms/int8_ms:.2f}×  ← use this on server/mobile")
+
+    if args.holdout_dir and int8_path and os.path.exists(int8_path):
+        # Never evaluate on images that were used for calibration
+        used = set(calib) if args.quant == "static" else set()
+        compare_quantized(fp32_path, int8_path, list_images(args.holdout_dir, args.holdout_count, skip=used),
+                          store=store)
+
+    if args.ort_artifacts is not None:
+        ort_artifacts([p for p in (fp32_path, int8_path) if p and os.path.exists(p)], args.ort_opt_level)
@@ -1,8 +1,30 @@
+"""Download the model checkpoint (Google Drive by default) for a fresh node.
+
+The file is fetched over ``--connections`` parallel HTTP Range requests
+into ``<dest>.part``.  The byte ranges still missing are tracked in
+``<dest>.part.json``, so an interrupted run resumes where it stopped (as
+long as the server still reports the same size / ETag).  When
+``--sha256`` is given (DRIVE_SHA256 for the default URL) the finished file
+is verified, and it is only renamed to ``<dest>`` once complete and
+verified, so a half-written checkpoint never sits at the destination.  Servers without Range support
+fall back to a single stream (restarted from zero after an interruption).
+
+    python download_checkpoint.py
+    python download_checkpoint.py --url http://mirror/ckpt.pth --dest ckpt.pth --sha256 <hex>
+    python download_checkpoint.py --check      # against a local stand-in HTTP server
+"""
+
+import argparse
+import hashlib
+import json
 import os
-import sys
-import urllib.request
-import urllib.error
 import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
 from rich.progress import (
     BarColumn,
     DownloadColumn,
@@ -14,6 +36,20 @@ from rich.progress import (
     TransferSpeedColumn,
 )
 
+DRIVE_URL = "https://drive.google.com/file/d/1d3t_HihVboToBf8qHi2o4hqtaEn0mxuC/view?usp=sharing"
+# SHA-256 (hex) of the checkpoint behind DRIVE_URL, checked by default when --url is DRIVE_URL.
+# None until pinned: the default run then prints the digest it got so it can be pinned here.
+DRIVE_SHA256 = None
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+READ_BYTES = 1 << 20          # per read() on a connection
+MIN_SEGMENT_BYTES = 8 << 20   # smaller files are not split further
+STATE_EVERY_BYTES = 16 << 20  # persist progress to the state file this often per segment
+RETRIES = 3                   # per segment, each retry resumes at the segment's current offset
+
+
+class DownloadError(Exception):
+    pass
+
 
 def extract_file_id(drive_url: str) -> str:
     """Extract file ID from Google Drive sharing URL."""
@@ -41,104 +77,354 @@ def get_direct_download_url(file_id: str) -> str:
     return f"https://drive.google.com/uc?export=download&id={file_id}"
 
 
-def download_file(url: str, dest_path: str, progress: Progress) -> None:
-    """Download file with progress bar."""
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+def _request(url: str, start: int = None, end: int = None) -> urllib.request.Request:
+    headers = {'User-Agent': USER_AGENT}
+    if start is not None:
+        headers['Range'] = f"bytes={start}-{'' if end is None else end}"
+    return urllib.request.Request(url, headers=headers)
 
-    if os.path.exists(dest_path):
-        print(f"File already exists: {dest_path}")
-        return
 
-    task_id = progress.add_task(f"Download {os.path.basename(dest_path)}", total=None)
+def _drive_confirm_url(url: str, html_content: str) -> str:
+    """Direct download URL behind Google Drive's virus scan page, or None if the page is not one."""
+    if 'Virus scan warning' not in html_content and 'Google Drive can\'t scan this file' not in html_content:
+        return None
+    # Extract the download form parameters using regex
+    confirm_match = re.search(r'<input[^>]*name="confirm"[^>]*value="([^"]*)"', html_content)
+    uuid_match = re.search(r'<input[^>]*name="uuid"[^>]*value="([^"]*)"', html_content)
+    if not (confirm_match and uuid_match):
+        return None
+    return (f"https://drive.usercontent.google.com/download?id={extract_file_id(url)}&export=download"
+            f"&confirm={confirm_match.group(1)}&uuid={uuid_match.group(1)}")
 
-    try:
-        # Handle Google Drive virus scan warning
-        req = urllib.request.Request(url, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
-
-        with urllib.request.urlopen(req) as response:
-            # Check if this is a Google Drive virus scan page
-            content_type = response.headers.get('Content-Type', '')
-            if 'text/html' in content_type:
-                html_content = response.read().decode('utf-8')
-                if 'Virus scan warning' in html_content or 'Google Drive can\'t scan this file' in html_content:
-                    print("Google Drive virus scan page detected. Extracting download link...")
-
-                    # Extract the download form parameters using regex
-                    confirm_match = re.search(r'<input[^>]*name="confirm"[^>]*value="([^"]*)"', html_content)
-                    uuid_match = re.search(r'<input[^>]*name="uuid"[^>]*value="([^"]*)"', html_content)
-
-                    if confirm_match and uuid_match:
-                        confirm = confirm_match.group(1)
-                        uuid_val = uuid_match.group(1)
-                        # Construct the proper download URL
-                        direct_url = f"https://drive.usercontent.google.com/download?id=1d3t_HihVboToBf8qHi2o4hqtaEn0mxuC&export=download&confirm={confirm}&uuid={uuid_val}"
-                        print(f"Using direct download URL with extracted parameters")
-
-                        # Retry with the direct URL
-                        req2 = urllib.request.Request(direct_url, headers={
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                        })
-                        response = urllib.request.urlopen(req2)
-                    else:
-                        print("Could not extract download parameters from Google Drive page.")
-                        print("Please download manually from:", url)
-                        print("HTML content preview:")
-                        print(html_content[:500] + "..." if len(html_content) > 500 else html_content)
-                        return
-
-            total_size = int(response.headers.get('Content-Length', 0))
-
-            if total_size > 0:
-                progress.update(task_id, total=total_size)
-
-            with open(dest_path, 'wb') as f:
-                downloaded = 0
-                while True:
-                    chunk = response.read(8192)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0:
-                        progress.update(task_id, completed=min(downloaded, total_size))
 
+def probe(url: str, timeout: float = 60) -> dict:
+    """Resolve ``url`` (following the Drive scan page) and report size, Range support and validator."""
+    with urllib.request.urlopen(_request(url, 0, 0), timeout=timeout) as response:
+        content_type = response.headers.get('Content-Type', '')
+        if 'text/html' in content_type:
+            html_content = response.read().decode('utf-8', errors='replace')
+            direct_url = _drive_confirm_url(url, html_content)
+            if direct_url is None:
+                preview = html_content[:500] + "..." if len(html_content) > 500 else html_content
+                raise DownloadError(f"Got an HTML page instead of the file, download manually from {url}\n{preview}")
+            print("Google Drive virus scan page detected, using the direct download URL")
+            return probe(direct_url, timeout)
+        content_range = response.headers.get('Content-Range', '')
+        if response.status == 206 and '/' in content_range and not content_range.endswith('/*'):
+            size, ranges = int(content_range.rsplit('/', 1)[1]), True
+        else:
+            length = response.headers.get('Content-Length')
+            size, ranges = (int(length) if length else None), False
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        return {'url': response.url, 'size': size, 'ranges': ranges, 'validator': validator}
+
+
+def plan_segments(size: int, connections: int) -> list:
+    """[start, end] inclusive byte ranges, at most ``connections`` of them, none under MIN_SEGMENT_BYTES."""
+    n = max(1, min(connections, size // MIN_SEGMENT_BYTES))
+    bounds = [size * k // n for k in range(n + 1)]
+    return [[bounds[k], bounds[k + 1] - 1] for k in range(n) if bounds[k + 1] > bounds[k]]
+
+
+class _State:
+    """Progress of a segmented download, persisted next to the .part file (atomically)."""
+
+    def __init__(self, path: str, info: dict, segments: list, done: list = None):
+        self.path = path
+        self.info = info
+        self.segments = segments
+        self.done = done or [0] * len(segments)   # bytes at the start of each segment known to be on disk
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, info: dict):
+        """The saved state if it belongs to the same remote file, else None."""
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('size') != info['size'] or saved.get('validator') != info['validator']:
+            return None
+        return cls(path, info, saved['segments'], saved['done'])
+
+    def save(self, k: int = None, n_done: int = None):
+        """Persist progress, recording ``n_done`` synced bytes for segment ``k`` first.
+
+        Only the thread owning segment ``k`` updates ``done[k]``, after an fsync
+        of the .part file, so a saved state never covers bytes not yet on disk.
+        """
+        # Under the lock: segment threads share the .tmp file
+        with self._lock:
+            if k is not None:
+                self.done[k] = n_done
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'size': self.info['size'], 'validator': self.info['validator'],
+                           'segments': self.segments, 'done': self.done}, f)
+            os.replace(self.path + '.tmp', self.path)
+
+    @property
+    def completed(self) -> int:
+        return sum(self.done)
+
+
+def _fetch_segment(url: str, part_path: str, state: _State, k: int, progress: Progress, task_id,
+                   timeout: float, retries: int) -> None:
+    """Fill segment ``k`` of the .part file, resuming at its saved offset and retrying dropped connections."""
+    start, end = state.segments[k]
+
+    def sync(f, offset):
+        f.flush()
+        os.fsync(f.fileno())
+        state.save(k, offset - start)
+
+    for attempt in range(retries + 1):
+        offset = start + state.done[k]
+        if offset > end:
+            return
+        try:
+            with urllib.request.urlopen(_request(url, offset, end), timeout=timeout) as response, \
+                    open(part_path, 'r+b') as f:
+                if response.status != 206:
+                    raise DownloadError(f"server ignored the Range request (HTTP {response.status})")
+                f.seek(offset)
+                synced = offset
+                try:
+                    while offset <= end:
+                        chunk = response.read(min(READ_BYTES, end + 1 - offset))
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        offset += len(chunk)
+                        progress.update(task_id, advance=len(chunk))
+                        if offset - synced >= STATE_EVERY_BYTES:
+                            sync(f, offset)
+                            synced = offset
+                finally:
+                    # Also when the connection drops: the bytes written so far are kept for the retry
+                    sync(f, offset)
+            if offset > end:
+                return
+        except (urllib.error.URLError, HTTPException, ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise DownloadError(f"segment {start}-{end} failed at byte {offset}: {e}") from e
+            time.sleep(min(2 ** attempt, 10))
+    raise DownloadError(f"segment {start}-{end} ended early at byte {start + state.done[k]}")
+
+
+def _fetch_stream(url: str, part_path: str, progress: Progress, task_id, timeout: float) -> None:
+    """Single connection without Range support: always from byte 0."""
+    with urllib.request.urlopen(_request(url), timeout=timeout) as response, open(part_path, 'wb') as f:
+        while chunk := response.read(READ_BYTES):
+            f.write(chunk)
+            progress.update(task_id, advance=len(chunk))
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(READ_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_file(url: str, dest_path: str, progress: Progress, connections: int = 4, sha256: str = None,
+                  timeout: float = 60, retries: int = RETRIES) -> bool:
+    """Download ``url`` to ``dest_path`` via ``<dest>.part``; returns True if a download took place.
+
+    An existing ``dest_path`` is kept if it matches ``sha256`` (or if no hash
+    is given); a mismatching one is downloaded again.  Raises DownloadError
+    on failure, leaving the .part file and its state for the next run.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+    if os.path.exists(dest_path):
+        if sha256 is None or sha256_file(dest_path) == sha256.lower():
+            print(f"File already exists: {dest_path}")
+            return False
+        print(f"{dest_path} does not match the expected SHA-256, downloading again")
+
+    part_path, state_path = dest_path + '.part', dest_path + '.part.json'
+    try:
+        info = probe(url, timeout)
     except urllib.error.HTTPError as e:
         if e.code == 403:
-            print("Google Drive download quota exceeded or file access denied.")
-            print("Please download manually from:", url)
-            return
-        else:
-            raise
+            raise DownloadError(f"Google Drive download quota exceeded or file access denied, "
+                                f"download manually from {url}") from e
+        raise
+    task_id = progress.add_task(f"Download {os.path.basename(dest_path)}", total=info['size'])
+
+    if info['ranges'] and info['size']:
+        state = _State.load(state_path, info) if os.path.exists(part_path) else None
+        if state is None:
+            state = _State(state_path, info, plan_segments(info['size'], connections))
+            with open(part_path, 'wb') as f:
+                f.truncate(info['size'])
+            state.save()
+        elif state.completed:
+            print(f"Resuming {part_path}: {state.completed / 1e6:.1f} of {info['size'] / 1e6:.1f} MB already there")
+        progress.update(task_id, completed=state.completed)
+        with ThreadPoolExecutor(max_workers=len(state.segments)) as pool:
+            futures = [pool.submit(_fetch_segment, info['url'], part_path, state, k, progress, task_id, timeout,
+                                   retries)
+                       for k in range(len(state.segments))]
+            for future in futures:
+                future.result()
+    else:
+        _fetch_stream(info['url'], part_path, progress, task_id, timeout)
+        if info['size'] is not None and os.path.getsize(part_path) != info['size']:
+            raise DownloadError(f"got {os.path.getsize(part_path)} of {info['size']} bytes")
+
+    if sha256 is not None:
+        actual = sha256_file(part_path)
+        if actual != sha256.lower():
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise DownloadError(f"SHA-256 mismatch: expected {sha256.lower()}, got {actual}")
+    os.replace(part_path, dest_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return True
+
+
+def make_progress(disable: bool = False) -> Progress:
+    return Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        TaskProgressColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeElapsedColumn(),
+        TimeRemainingColumn(),
+        disable=disable,
+    )
+
 
-    progress.update(task_id, completed=progress.tasks[task_id].total or progress.tasks[task_id].completed)
+def self_check(size: int = 40 << 20, connections: int = 4) -> bool:
+    """Exercise download_file against a local stand-in server: parallel, resume, hash mismatch, no Range."""
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+    payload = os.urandom(size)
+    digest = hashlib.sha256(payload).hexdigest()
+    server_state = {'ranges': True, 'fail_after': None, 'served': 0}
+    lock = threading.Lock()
 
-def main() -> int:
-    """Download the model checkpoint from Google Drive."""
-    drive_url = "https://drive.google.com/file/d/1d3t_HihVboToBf8qHi2o4hqtaEn0mxuC/view?usp=sharing"
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    dest_path = os.path.join(script_dir, "ultimate_tiled_multitask.pth")  # Save with proper name
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match and server_state['ranges']:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else size - 1
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('ETag', f'"{digest[:16]}"')
+            self.end_headers()
+            pos = start
+            while pos <= end:
+                n = min(256 << 10, end + 1 - pos)
+                with lock:
+                    budget = server_state['fail_after']
+                    if budget is not None and server_state['served'] + n > budget:
+                        return   # drop the connection mid-body
+                    server_state['served'] += n
+                try:
+                    self.wfile.write(payload[pos:pos + n])
+                except ConnectionError:
+                    return   # the client hung up (e.g. after reading the probe's headers)
+                pos += n
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/checkpoint.pth'
+    progress = make_progress(disable=True)
+    ok = True
+
+    def report(name, passed, detail=''):
+        nonlocal ok
+        ok &= passed
+        print(f"{'OK  ' if passed else 'FAIL'} {name}{f'  ({detail})' if detail else ''}")
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, 'ckpt.pth')
+            t0 = time.perf_counter()
+            download_file(url, dest, progress, connections=connections, sha256=digest)
+            report('parallel download + SHA-256', sha256_file(dest) == digest,
+                   f"{size / 1e6 / (time.perf_counter() - t0):.0f} MB/s over {connections} connections")
+            os.remove(dest)
+
+            # Connections drop after 60% of the bytes; no retries, so the run fails and leaves .part + state
+            server_state.update(fail_after=int(size * 0.6), served=0)
+            try:
+                download_file(url, dest, progress, connections=connections, sha256=digest, retries=0)
+                report('interrupted run fails', False, 'download unexpectedly succeeded')
+            except DownloadError:
+                report('interrupted run fails', not os.path.exists(dest) and os.path.exists(dest + '.part'),
+                       'no file at dest, .part kept')
+            server_state.update(fail_after=None, served=0)
+            download_file(url, dest, progress, connections=connections, sha256=digest)
+            resumed = server_state['served']
+            report('resume from .part', sha256_file(dest) == digest and resumed < size * 0.5,
+                   f"second run fetched {resumed / size:.0%} of the file")
+            report('state file removed', not os.path.exists(dest + '.part.json'))
+
+            os.remove(dest)
+            try:
+                download_file(url, dest, progress, connections=connections, sha256='0' * 64)
+                report('SHA-256 mismatch rejected', False, 'download unexpectedly succeeded')
+            except DownloadError:
+                report('SHA-256 mismatch rejected', not os.path.exists(dest) and not os.path.exists(dest + '.part'))
+
+            server_state['ranges'] = False
+            download_file(url, dest, progress, connections=connections, sha256=digest)
+            report('server without Range support', sha256_file(dest) == digest)
+    finally:
+        server.shutdown()
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Download the model checkpoint (resumable, parallel, verified)')
+    parser.add_argument('--url', default=DRIVE_URL, help='file URL; Google Drive sharing links are resolved')
+    parser.add_argument('--dest', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       'ultimate_tiled_multitask.pth'))
+    parser.add_argument('--sha256',
+                        help='expected SHA-256 (hex) of the file; checked before it is put in place '
+                             '(default: DRIVE_SHA256 for the default --url)')
+    parser.add_argument('--connections', type=int, default=4, help='parallel Range requests')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds without data before a connection is retried')
+    parser.add_argument('--check', action='store_true', help='self-test against a local stand-in HTTP server')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    """Download the model checkpoint from Google Drive (or --url)."""
+    args = parse_args(argv)
+    if args.check:
+        return 0 if self_check(connections=args.connections) else 1
 
     try:
-        file_id = extract_file_id(drive_url)
-        download_url = get_direct_download_url(file_id)
-
-        progress = Progress(
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            TaskProgressColumn(),
-            DownloadColumn(),
-            TransferSpeedColumn(),
-            TimeElapsedColumn(),
-            TimeRemainingColumn(),
-        )
-
-        with progress:
-            download_file(download_url, dest_path, progress)
-
-        print(f"Checkpoint downloaded to: {dest_path}")
+        url = args.url
+        sha256 = args.sha256 or (DRIVE_SHA256 if url == DRIVE_URL else None)
+        if 'drive.google.com' in url:
+            url = get_direct_download_url(extract_file_id(url))
+
+        with make_progress() as progress:
+            download_file(url, args.dest, progress, connections=args.connections, sha256=sha256,
+                          timeout=args.timeout)
+
+        print(f"Checkpoint downloaded to: {args.dest}")
+        if sha256 is None:
+            print(f"Not verified (no expected SHA-256); this file's SHA-256 is {sha256_file(args.dest)}")
         return 0
 
     except Exception as e:
@@ -147,4 +433,4 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    raise SystemExit(main())
\ No newline at end of file
+    raise SystemExit(main())
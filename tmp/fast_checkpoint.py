@@ -0,0 +1,191 @@
+"""Memory-mappable checkpoint format for fast cold starts.
+
+``torch.load(..., weights_only=False)`` unpickles the whole ~200 MB training
+checkpoint into fresh memory on every run, and UltimateSpecialist then
+spends time randomly initialising weights that are immediately overwritten.
+This module converts the checkpoint once into
+
+    <name>.safetensors   the model state_dict (standard safetensors layout)
+    <name>.json          m_stats, model name and tiling config
+
+and loads it by building the model on the ``meta`` device (no allocation,
+no init) and assigning tensors that are zero-copy views of a private
+(copy-on-write) mmap of the file.  Pages are read lazily by the first
+forward pass and shared through the page cache between worker processes.
+
+    python fast_checkpoint.py --convert                       # ultimate_tiled_multitask.pth -> .safetensors/.json
+    python submit.py --checkpoint ultimate_tiled_multitask.safetensors
+    python fast_checkpoint.py --bench                         # cold-start report, .pth vs .safetensors
+
+Writing needs the ``safetensors`` package; loading only needs torch.
+"""
+
+import argparse
+import itertools
+import json
+import mmap
+import os
+import struct
+import subprocess
+import sys
+
+import numpy as np
+import torch
+
+from submit import Config
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+
+def default_output(pth_path):
+    return os.path.splitext(pth_path)[0] + '.safetensors'
+
+
+def sidecar_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def convert(pth_path=None, out_path=None, model_name=None):
+    """Write ``pth_path`` as <out>.safetensors + <out>.json; returns the .safetensors path."""
+    from safetensors.torch import save_file
+
+    pth_path = pth_path or Config.CHECKPOINT
+    out_path = out_path or default_output(pth_path)
+    ckpt = torch.load(pth_path, map_location='cpu', weights_only=False)
+    # clone: save_file refuses tensors that share storage
+    state = {k: v.detach().clone().contiguous() for k, v in ckpt['model'].items()}
+    save_file(state, out_path)
+
+    m_stats = [np.asarray(s) for s in ckpt['m_stats']]
+    meta = {
+        'model_name': model_name or Config.MODEL_NAME,
+        'tile_size': Config.TILE_SIZE,
+        'grid': [Config.GRID_ROWS, Config.GRID_COLS],
+        'm_stats': [s.tolist() for s in m_stats],
+        'm_stats_dtype': str(m_stats[0].dtype),
+        'source': os.path.abspath(pth_path),
+    }
+    with open(sidecar_path(out_path), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f"Wrote {out_path} ({os.path.getsize(out_path) / 1e6:.1f} MB) and {sidecar_path(out_path)}")
+    return out_path
+
+
+def map_state_dict(path):
+    """Tensors of a .safetensors file as zero-copy views of a copy-on-write mmap."""
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        # ACCESS_COPY: writable for torch, but writes never reach the file
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_len
+    state = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        if end == start:
+            state[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        count = (end - start) // dtype.itemsize
+        # frombuffer keeps a reference to the mmap, which stays open as long as any tensor does
+        state[name] = torch.frombuffer(buf, dtype=dtype, count=count, offset=data_start + start).view(info['shape'])
+    return state
+
+
+def load_fast(path, fused_heads=False):
+    """(model, m_stats) from a converted checkpoint without unpickling or random init."""
+    from submit import UltimateSpecialist
+    from fused_decoder import fuse_count_heads_state_dict
+
+    with open(sidecar_path(path)) as f:
+        meta = json.load(f)
+    with torch.device('meta'):
+        model = UltimateSpecialist(meta['model_name'], fused_heads=fused_heads)
+    state = map_state_dict(path)
+    if fused_heads:
+        state = fuse_count_heads_state_dict(state)
+    model.load_state_dict(state, assign=True)
+    missing = [n for n, t in itertools.chain(model.named_parameters(), model.named_buffers()) if t.is_meta]
+    if missing:
+        raise RuntimeError(f"{path} does not provide {missing}")
+    m_stats = [np.asarray(s, dtype=meta['m_stats_dtype']) for s in meta['m_stats']]
+    return model.eval(), m_stats
+
+
+def load_m_stats(path):
+    """m_stats from the JSON sidecar, without touching the weights."""
+    with open(sidecar_path(path)) as f:
+        meta = json.load(f)
+    return [np.asarray(s, dtype=meta['m_stats_dtype']) for s in meta['m_stats']]
+
+
+_COLD_START = r'''
+import json, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {script_dir!r})
+import submit
+{eager}
+t1 = time.perf_counter()
+submit.Config.MODEL_NAME = {model_name!r}
+model, m_stats = submit.load_model({checkpoint!r})
+t2 = time.perf_counter()
+rss = [int(l.split()[1]) for l in open('/proc/self/status') if l.startswith(('VmHWM', 'VmRSS'))]
+print(json.dumps({{'import_ms': (t1 - t0) * 1e3, 'load_ms': (t2 - t1) * 1e3, 'rss_mb': rss[1] / 1024, 'peak_mb': rss[0] / 1024}}))
+'''
+
+# What submit.py imported at module level before the heavy imports were deferred
+EAGER_IMPORTS = 'import pandas, timm, albumentations, albumentations.pytorch, tqdm, cv2'
+
+
+def cold_start(checkpoint, model_name, eager=False):
+    """Import + load time of submit.load_model(checkpoint) in a fresh interpreter."""
+    code = _COLD_START.format(script_dir=Config.SCRIPT_DIR, eager=EAGER_IMPORTS if eager else '',
+                              model_name=model_name, checkpoint=checkpoint)
+    out = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def bench(pth_path, fast_path, model_name, repeats=3):
+    cases = [('.pth, eager imports (before)', pth_path, True),
+             ('.pth, lazy imports', pth_path, False),
+             ('.safetensors, lazy imports (after)', fast_path, False)]
+    print(f"{'case':<36} {'import ms':>10} {'load ms':>9} {'total ms':>9} {'RSS MB':>8} {'peak MB':>8}")
+    for label, path, eager in cases:
+        # best of N: the first run may still be pulling files into the page cache
+        runs = [cold_start(path, model_name, eager) for _ in range(repeats)]
+        r = min(runs, key=lambda r: r['import_ms'] + r['load_ms'])
+        print(f"{label:<36} {r['import_ms']:>10.0f} {r['load_ms']:>9.0f} {r['import_ms'] + r['load_ms']:>9.0f} "
+              f"{r['rss_mb']:>8.0f} {r['peak_mb']:>8.0f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert the checkpoint to a mmap-able format / report cold start')
+    parser.add_argument('--convert', action='store_true', help='write <checkpoint>.safetensors + .json')
+    parser.add_argument('--bench', action='store_true', help='cold-start time of .pth vs .safetensors')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT, help='source .pth checkpoint')
+    parser.add_argument('--out', help='output .safetensors path (default: next to the checkpoint)')
+    parser.add_argument('--model-name', default=Config.MODEL_NAME)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+    if not (args.convert or args.bench):
+        parser.error('nothing to do, pass --convert and/or --bench')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = args.out or default_output(args.checkpoint)
+    if args.convert:
+        convert(args.checkpoint, out, model_name=args.model_name)
+    if args.bench:
+        bench(args.checkpoint, out, args.model_name, repeats=args.repeats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""Opt-in fast CPU execution path for UltimateSpecialist.
+
+The reference path runs the eager model in NCHW FP32 under ``no_grad``.
+FastCPUModel wraps the same weights with
+
+    channels_last   parameters (and therefore every conv activation) in NHWC,
+                    the layout oneDNN's CPU convolutions are fastest in
+    inference_mode  no autograd bookkeeping, no version counters
+    bf16            optional torch.autocast(bfloat16); only enabled when the
+                    CPU has native bf16 (AVX512-BF16 / AMX), else left off
+    compile         'script': torch.jit.trace + torch.jit.freeze per input
+                    shape, saved under the cache dir and reloaded by later
+                    runs; 'inductor': torch.compile with its on-disk FX graph
+                    cache pointed at the same dir
+
+bf16 and compilation change numerics, so ``--check`` reports the count and
+measure drift of a configuration against the FP32 eager path, in output
+units (grains / de-normalised measures) and as changed rounded counts:
+
+    python fast_cpu.py --check --images 16 --bf16 --compile script
+    python submit.py --fast-cpu --bf16 --compile script
+"""
+
+import argparse
+import copy
+import hashlib
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from submit import Config
+
+COMPILE_MODES = ('none', 'script', 'inductor')
+
+
+def bf16_supported():
+    """True when oneDNN can run bfloat16 natively on this CPU."""
+    try:
+        return torch.backends.mkldnn.is_available() and bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class _Bound(nn.Module):
+    """Binds forward keyword options so the model can be traced with (x, meta) only."""
+
+    def __init__(self, model, tile_chunk=0):
+        super().__init__()
+        self.m = model
+        self.tile_chunk = tile_chunk
+
+    def forward(self, x, meta):
+        return self.m(x, meta, tile_chunk=self.tile_chunk)
+
+
+class FastCPUModel:
+    """Callable ``(x, meta) -> (counts, measures)`` running ``model`` with the fast CPU options.
+
+    ``model`` is converted to channels_last in place.  ``cache_tag`` must
+    identify the weights (checkpoint path, size, mtime) so cached graphs are
+    never reused for a different checkpoint.
+    """
+
+    def __init__(self, model, bf16=False, compile='none', cache_dir=None, cache_tag=None,
+                 skip_zero_heads=False, tile_chunk=0):
+        if compile not in COMPILE_MODES:
+            raise ValueError(f"compile must be one of {COMPILE_MODES}, got {compile!r}")
+        if compile != 'none' and skip_zero_heads:
+            raise ValueError('skip_zero_heads is data dependent and cannot be compiled')
+        if bf16 and not bf16_supported():
+            print("bf16 requested but this CPU has no native bfloat16 support; staying in FP32")
+            bf16 = False
+        self.model = model.eval().to(memory_format=torch.channels_last)
+        self.bf16 = bf16
+        self.compile = compile
+        self.cache_dir = cache_dir
+        self.cache_tag = cache_tag
+        self.skip_zero_heads = skip_zero_heads
+        self.tile_chunk = tile_chunk
+        self._graphs = {}
+        if compile == 'inductor':
+            if cache_dir:
+                # assigned, not setdefault: importing timm already makes inductor fill in its /tmp default
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.join(cache_dir, 'inductor')
+            self._compiled = torch.compile(_Bound(self.model, tile_chunk), dynamic=False)
+
+    def _autocast(self):
+        return torch.autocast('cpu', dtype=torch.bfloat16, enabled=self.bf16)
+
+    def _cache_path(self, shape_key):
+        if not self.cache_dir:
+            return None
+        key = repr((self.cache_tag, shape_key, self.bf16, self.tile_chunk, torch.__version__))
+        return os.path.join(self.cache_dir, f'frozen_{hashlib.sha256(key.encode()).hexdigest()[:16]}.pt')
+
+    def _frozen_graph(self, x, meta):
+        """Traced + frozen TorchScript graph for this input shape, from the disk cache when present."""
+        shape_key = (tuple(x.shape), tuple(meta.shape))
+        graph = self._graphs.get(shape_key)
+        if graph is not None:
+            return graph
+        path = self._cache_path(shape_key)
+        if path and os.path.exists(path):
+            graph = torch.jit.load(path)
+        else:
+            with torch.no_grad(), self._autocast():
+                graph = torch.jit.freeze(torch.jit.trace(_Bound(self.model, self.tile_chunk).eval(), (x, meta),
+                                                         check_trace=False))
+            if path:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                torch.jit.save(graph, path + '.tmp')
+                os.replace(path + '.tmp', path)
+        self._graphs[shape_key] = graph
+        return graph
+
+    def __call__(self, x, meta, tile_mask=None):
+        """``tile_mask`` (tile_filter.py) has a data-dependent shape and is only supported uncompiled."""
+        if tile_mask is not None and self.compile != 'none':
+            raise ValueError('tile_mask cannot be used with a compiled graph')
+        if self.compile == 'script':
+            graph = self._frozen_graph(x, meta)
+            with torch.inference_mode(), self._autocast():
+                counts, measures = graph(x, meta)
+        else:
+            with torch.inference_mode(), self._autocast():
+                if self.compile == 'inductor':
+                    counts, measures = self._compiled(x, meta)
+                else:
+                    counts, measures = self.model(x, meta, skip_zero_heads=self.skip_zero_heads,
+                                                  tile_chunk=self.tile_chunk, tile_mask=tile_mask)
+        return counts.float(), measures.float()
+
+
+def weights_tag(checkpoint_path, fused_heads=False):
+    """Identifies a checkpoint for the compiled-graph cache."""
+    st = os.stat(checkpoint_path)
+    return (Config.MODEL_NAME, os.path.abspath(checkpoint_path), st.st_size, st.st_mtime_ns, fused_heads)
+
+
+def drift_report(reference, fast, batches, m_stats):
+    """Max count / measure drift of ``fast`` against ``reference`` over (x, meta) batches, in output units."""
+    ref_c, ref_m, fast_c, fast_m, times = [], [], [], [], {'reference': [], 'fast': []}
+    for i, (x, meta) in enumerate(batches):
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            c, m = reference(x, meta)
+        t1 = time.perf_counter()
+        fc, fm = fast(x, meta)
+        t2 = time.perf_counter()
+        if i:   # the first batch pays for tracing / compilation
+            times['reference'].append(t1 - t0)
+            times['fast'].append(t2 - t1)
+        ref_c.append(c.numpy()); ref_m.append(m.numpy()); fast_c.append(fc.numpy()); fast_m.append(fm.numpy())
+
+    ref_c, fast_c = np.concatenate(ref_c) / Config.SCALE, np.concatenate(fast_c) / Config.SCALE
+    ref_m, fast_m = (np.concatenate(a) * (m_stats[1] + 1e-8) for a in (ref_m, fast_m))
+    count_drift, measure_drift = np.abs(fast_c - ref_c).max(axis=0), np.abs(fast_m - ref_m).max(axis=0)
+    rounded = (np.maximum(0, np.round(fast_c)) != np.maximum(0, np.round(ref_c))).sum(axis=0)
+
+    print(f"{'column':<22} {'max drift':>10} {'rounded changed':>16}")
+    for k, col in enumerate(Config.COUNT_COLS):
+        print(f"{col:<22} {count_drift[k]:>10.4f} {rounded[k]:>16d}")
+    for k, col in enumerate(Config.MEASURE_COLS):
+        print(f"{col:<22} {measure_drift[k]:>10.5f} {'':>16}")
+    print(f"max count drift {count_drift.max():.4f} grains, max measure drift {measure_drift.max():.5f}, "
+          f"{int(rounded.sum())} rounded counts changed over {len(ref_c)} images")
+    if times['fast']:
+        ref_ms, fast_ms = np.mean(times['reference']) * 1e3, np.mean(times['fast']) * 1e3
+        print(f"per batch: reference {ref_ms:.0f} ms, fast {fast_ms:.0f} ms ({ref_ms / fast_ms:.2f}x)")
+    return {'count_drift': count_drift, 'measure_drift': measure_drift, 'rounded_changed': rounded}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Drift and speed of the fast CPU path against FP32 eager')
+    parser.add_argument('--check', action='store_true', help='report drift and speed (the only action)')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT)
+    parser.add_argument('--images', type=int, default=16, help='first N Test.csv images')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE)
+    parser.add_argument('--bf16', action='store_true')
+    parser.add_argument('--compile', choices=COMPILE_MODES, default='none')
+    parser.add_argument('--compile-cache', default=Config.COMPILE_CACHE)
+    args = parser.parse_args(argv)
+    if not args.check:
+        parser.error('nothing to do, pass --check')
+    return args
+
+
+def main(argv=None):
+    import albumentations as A
+    import pandas as pd
+    from albumentations.pytorch import ToTensorV2
+    from submit import build_meta, iter_batches, load_model, load_tiles, rice_type_index
+
+    args = parse_args(argv)
+    model, m_stats = load_model(args.checkpoint)
+    reference = copy.deepcopy(model)
+    fast = FastCPUModel(model, bf16=args.bf16, compile=args.compile, cache_dir=args.compile_cache,
+                        cache_tag=weights_tag(args.checkpoint))
+    print(f"fast path: channels_last, inference_mode, bf16={fast.bf16}, compile={fast.compile}")
+
+    test_df = pd.read_csv(Config.TEST_CSV).iloc[:args.images]
+    transform = A.Compose([A.Resize(Config.TILE_SIZE, Config.TILE_SIZE), A.Normalize(), ToTensorV2()])
+    batches = ((torch.stack([load_tiles(i, transform) for i in batch['ID']]),
+                build_meta([rice_type_index(c) for c in batch['Comment']]))
+               for batch in iter_batches(test_df, args.batch_size))
+    drift_report(reference, fast, batches, m_stats)
+
+
+if __name__ == '__main__':
+    main()
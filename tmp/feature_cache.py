@@ -0,0 +1,141 @@
+"""LRU cache of backbone features for re-scoring the same images.
+
+The rice-type meta only enters after the backbone, so the ConvNeXt features
+(f16/f32) of an image depend on nothing but its pixels, the tiling config
+and the weights.  Re-running a scan with a corrected rice type, or
+re-scoring a set while tuning post-processing, then only costs the head
+passes.
+
+Entries are keyed by a SHA-256 of the raw image file plus a tag describing
+the tile config and checkpoint.  The in-memory part is bounded by
+``max_bytes``; entries evicted from memory are spilled to ``spill_dir``
+(when given) and reloaded from there on the next hit.  ``flush()`` writes
+the entries still in memory too, so the next run (a new process) finds
+every image on disk.  The spill directory is not size-bounded, so point it
+at scratch space.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class FeatureCache:
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = OrderedDict()   # key -> (f16, f32), most recently used last
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Worker processes only get a view of the spill directory; the
+        # in-memory entries (and the lock) stay with the owning process.
+        return {'max_bytes': self.max_bytes, 'spill_dir': self.spill_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'], spill_dir=state['spill_dir'])
+
+    @staticmethod
+    def content_key(data, tag):
+        """Cache key for raw image bytes under a config tag (tile size, grid, tiler, checkpoint)."""
+        h = hashlib.sha256(data)
+        h.update(repr(tag).encode())
+        return h.hexdigest()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f'{key}.pt')
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return bool(self.spill_dir) and os.path.exists(self._spill_path(key))
+
+    def get(self, key):
+        """Return (f16, f32) for ``key`` or None, updating the hit/miss counters."""
+        with self._lock:
+            feats = self._entries.get(key)
+            if feats is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return feats
+        if self.spill_dir and os.path.exists(self._spill_path(key)):
+            feats = torch.load(self._spill_path(key), map_location='cpu')
+            self.disk_hits += 1
+            self.put(key, feats)
+            return feats
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, feats):
+        """Store (f16, f32) CPU tensors for ``key``, evicting least recently used entries."""
+        feats = tuple(f.detach().to('cpu') for f in feats)
+        size = sum(f.numel() * f.element_size() for f in feats)
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = feats
+            self._bytes += size
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_feats = self._entries.popitem(last=False)
+                self._bytes -= sum(f.numel() * f.element_size() for f in old_feats)
+                evicted.append((old_key, old_feats))
+        if self.spill_dir:
+            for old_key, old_feats in evicted:
+                self._spill(old_key, old_feats)
+
+    def _spill(self, key, feats):
+        if not os.path.exists(self._spill_path(key)):
+            tmp_path = self._spill_path(key) + '.tmp'
+            torch.save(feats, tmp_path)
+            os.replace(tmp_path, self._spill_path(key))
+
+    def flush(self):
+        """Write every in-memory entry not yet in ``spill_dir`` (no-op without one)."""
+        if not self.spill_dir:
+            return
+        with self._lock:
+            entries = list(self._entries.items())
+        for key, feats in entries:
+            self._spill(key, feats)
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'entries': len(self._entries), 'mbytes': self._bytes / 2**20}
+
+
+def forward_cached(model, cache, keys, tiles, meta, reload, skip_zero_heads=False):
+    """Batched forward where the backbone only runs for images whose features are not cached.
+
+    ``tiles[i]`` is the (N, C, H, W) tile tensor of image ``keys[i]``, or None
+    when it was skipped because the features were cached at load time;
+    ``reload(i)`` rebuilds it if that entry has since been evicted.
+    """
+    feats = [cache.get(key) for key in keys]
+    missing = [i for i, f in enumerate(feats) if f is None]
+    if missing:
+        device = meta.device
+        x = torch.stack([tiles[i] if tiles[i] is not None else reload(i) for i in missing]).to(device)
+        n = x.shape[1]
+        f16, f32 = model.extract_features(x)
+        for j, i in enumerate(missing):
+            # clone so each entry owns its memory instead of pinning the whole batch
+            feats[i] = (f16[j * n:(j + 1) * n].clone(), f32[j * n:(j + 1) * n].clone())
+            cache.put(keys[i], feats[i])
+
+    n = feats[0][0].shape[0]
+    f16 = torch.cat([f[0] for f in feats]).to(meta.device)
+    f32 = torch.cat([f[1] for f in feats]).to(meta.device)
+    return model.decode(f16, f32, meta, len(keys), n, skip_zero_heads=skip_zero_heads)
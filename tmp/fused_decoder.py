@@ -0,0 +1,156 @@
+"""Fused replacement for the nine MultiScaleCSRDecoder count heads.
+
+Every count head reduces the same f16/f32 backbone features, so the nine
+``reduce_16``/``reduce_32`` 1x1 convs become one wide conv each, and the
+per-head ``backend`` convs become grouped convs with one group per head.
+All nine density maps come out of a single pass as (B*N, 9, h16, w16).
+
+Checkpoints trained with the ModuleList layout (``count_heads.{i}.*``) are
+converted with ``fuse_count_heads_state_dict``; the grouped weights are the
+per-head weights concatenated along the output dimension, so the fused
+module computes exactly the same function.
+
+    python fused_decoder.py --check [--checkpoint ultimate_tiled_multitask.pth]
+"""
+
+import argparse
+import re
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+MID_CH = 128
+META_CH = 32
+
+
+class FusedCSRDecoder(nn.Module):
+    def __init__(self, in_channels_list, n_heads=9):
+        super().__init__()
+        self.n_heads = n_heads
+        self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
+
+        # Same parameter names/positions as MultiScaleCSRDecoder, one slice per head
+        self.reduce_32 = nn.Sequential(nn.Conv2d(in_channels_list[-1], n_heads * MID_CH, 1), nn.ReLU(inplace=True))
+        self.reduce_16 = nn.Sequential(nn.Conv2d(in_channels_list[-2], n_heads * MID_CH, 1), nn.ReLU(inplace=True))
+
+        group_in = MID_CH * 2 + META_CH
+        self.backend = nn.Sequential(
+            nn.Conv2d(n_heads * group_in, n_heads * 128, kernel_size=3, padding=1, groups=n_heads),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(n_heads * 128, n_heads * 64, kernel_size=3, padding=1, groups=n_heads),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(n_heads * 64, n_heads, kernel_size=1, groups=n_heads)
+        )
+
+    def forward(self, feats_16, feats_32, meta_map_16, heads=None):
+        """Decode multi-scale features into density maps at once: (B*N, len(heads), h16, w16).
+
+        ``heads`` selects a subset of head indices (default: all); only the
+        weight slices of those heads are used, so skipped heads cost nothing.
+        """
+        n_heads = self.n_heads if heads is None else len(heads)
+        convs = self._conv_params() if heads is None else self._sliced_conv_params(heads)
+        (w32, b32), (w16, b16), (w0, b0), (w1, b1), (w2, b2) = convs
+
+        f32_up = self.up(F.relu(F.conv2d(feats_32, w32, b32)))
+        f16 = F.relu(F.conv2d(feats_16, w16, b16))
+
+        if f32_up.shape != f16.shape:
+            f32_up = F.interpolate(f32_up, size=f16.shape[2:], mode='bilinear', align_corners=True)
+
+        # Interleave per head: [f16_h, f32_up_h, meta] so every group sees the original concat order
+        bn, _, h, w = f16.shape
+        combined = torch.cat([
+            f16.view(bn, n_heads, MID_CH, h, w),
+            f32_up.view(bn, n_heads, MID_CH, h, w),
+            meta_map_16.unsqueeze(1).expand(-1, n_heads, -1, -1, -1),
+        ], dim=2).view(bn, -1, h, w)
+
+        x = F.relu(F.conv2d(combined, w0, b0, padding=1, groups=n_heads))
+        x = F.relu(F.conv2d(x, w1, b1, padding=1, groups=n_heads))
+        return F.conv2d(x, w2, b2, groups=n_heads)
+
+    def _conv_params(self):
+        """(weight, bias) of reduce_32, reduce_16 and the three backend convs, in that order."""
+        return [(m.weight, m.bias) for m in self.modules() if isinstance(m, nn.Conv2d)]
+
+    def _sliced_conv_params(self, heads):
+        """Like _conv_params, restricted to the output channels (groups) of ``heads``."""
+        sliced = []
+        for weight, bias in self._conv_params():
+            per_head = weight.shape[0] // self.n_heads
+            idx = torch.cat([torch.arange(h * per_head, (h + 1) * per_head) for h in heads]).to(weight.device)
+            sliced.append((weight.index_select(0, idx), bias.index_select(0, idx)))
+        return sliced
+
+
+def fuse_count_heads_state_dict(state_dict, prefix='count_heads.'):
+    """Convert ``count_heads.{i}.*`` ModuleList weights into the FusedCSRDecoder layout.
+
+    Keys outside ``prefix`` are passed through unchanged.  The fused keys keep
+    the same prefix (``count_heads.reduce_32.0.weight`` …), so the result loads
+    into ``UltimateSpecialist(..., fused_heads=True)`` directly.
+    """
+    pattern = re.compile(re.escape(prefix) + r'(\d+)\.(.+)')
+    per_param = {}
+    fused = {}
+    for key, value in state_dict.items():
+        match = pattern.fullmatch(key)
+        if match is None:
+            fused[key] = value
+            continue
+        head, name = int(match.group(1)), match.group(2)
+        per_param.setdefault(name, {})[head] = value
+
+    for name, heads in per_param.items():
+        # Grouped conv weights/biases are the per-head tensors stacked along the output dim
+        fused[prefix + name] = torch.cat([heads[i] for i in sorted(heads)], dim=0)
+    return fused
+
+
+def fuse_count_heads(heads):
+    """Build a FusedCSRDecoder equivalent to an existing ModuleList of MultiScaleCSRDecoder."""
+    in_channels = [heads[0].reduce_16[0].in_channels, heads[0].reduce_32[0].in_channels]
+    fused = FusedCSRDecoder(in_channels, n_heads=len(heads))
+    state = fuse_count_heads_state_dict({f'{i}.{k}': v for i, head in enumerate(heads)
+                                         for k, v in head.state_dict().items()}, prefix='')
+    fused.load_state_dict(state)
+    return fused.to(next(heads.parameters()).device)
+
+
+def check_equivalence(heads, n_tiles=4, size16=(14, 14), atol=1e-4):
+    """Compare fused vs sequential heads on random features; return the max abs difference."""
+    in16, in32 = heads[0].reduce_16[0].in_channels, heads[0].reduce_32[0].in_channels
+    fused = fuse_count_heads(heads).eval()
+    heads.eval()
+
+    h, w = size16
+    f16 = torch.randn(n_tiles, in16, h, w)
+    f32 = torch.randn(n_tiles, in32, (h + 1) // 2, (w + 1) // 2)
+    meta = torch.randn(n_tiles, META_CH, 1, 1).expand(-1, -1, h, w)
+    with torch.no_grad():
+        ref = torch.cat([head(f16, f32, meta) for head in heads], dim=1)
+        out = fused(f16, f32, meta)
+    max_diff = (ref - out).abs().max().item()
+    print(f"{'OK  ' if max_diff <= atol else 'FAIL'} fused vs sequential heads: max |diff| = {max_diff:.2e} "
+          f"(atol {atol:.0e}, {n_tiles} tiles, {h}x{w})")
+    return max_diff <= atol
+
+
+if __name__ == '__main__':
+    from submit import Config, UltimateSpecialist
+
+    parser = argparse.ArgumentParser(description='Equivalence check of FusedCSRDecoder against the 9 sequential heads')
+    parser.add_argument('--check', action='store_true', required=True)
+    parser.add_argument('--checkpoint', help='use trained count_heads weights instead of random init')
+    parser.add_argument('--model-name', default=Config.MODEL_NAME)
+    args = parser.parse_args()
+
+    torch.manual_seed(Config.SEED)
+    model = UltimateSpecialist(args.model_name)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu', weights_only=False)['model'])
+    ok = all([check_equivalence(model.count_heads, size16=(14, 14)),
+              check_equivalence(model.count_heads, size16=(32, 32))])
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,98 @@
+"""Load-test client for serve.py.
+
+Sends ``--requests`` POST /predict calls from ``--concurrency`` threads, each
+holding one keep-alive connection.  The images are cycled from ``--images``
+(default: the test set).  It reports client-side latency percentiles,
+throughput and the status-code mix (503s are backpressure rejections), then
+prints the server's own /metrics.
+
+    python serve.py --max-batch 8 &
+    python load_test.py --concurrency 16 --requests 200
+"""
+
+import argparse
+import glob
+import http.client
+import itertools
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from submit import Config
+
+
+def worker(host, port, jobs, lock, latencies, statuses):
+    conn = http.client.HTTPConnection(host, port, timeout=300)
+    try:
+        while True:
+            with lock:
+                job = next(jobs, None)
+            if job is None:
+                return
+            body, rice_type, image_id = job
+            start = time.perf_counter()
+            conn.request('POST', f'/predict?rice_type={rice_type}&id={image_id}', body=body,
+                         headers={'Content-Type': 'application/octet-stream'})
+            response = conn.getresponse()
+            response.read()
+            elapsed = (time.perf_counter() - start) * 1e3
+            with lock:
+                statuses[response.status] += 1
+                if response.status == 200:
+                    latencies.append(elapsed)
+    finally:
+        conn.close()
+
+
+def run(host, port, images, n_requests, concurrency):
+    payloads = []
+    for i, path in enumerate(images):
+        with open(path, 'rb') as f:
+            payloads.append((f.read(), list(Config.RICE_TYPES)[i % 3], os.path.splitext(os.path.basename(path))[0]))
+    jobs = itertools.islice(itertools.cycle(payloads), n_requests)
+    lock = threading.Lock()
+    latencies, statuses = [], Counter()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(host, port, jobs, lock, latencies, statuses))
+               for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+
+    print(f"{n_requests} requests, concurrency {concurrency}, {wall:.2f}s wall")
+    print(f"status codes: {dict(sorted(statuses.items()))}")
+    if latencies:
+        a = np.asarray(latencies)
+        print(f"throughput: {len(a) / wall:.2f} img/s   latency ms: p50 {np.percentile(a, 50):.1f}  "
+              f"p95 {np.percentile(a, 95):.1f}  p99 {np.percentile(a, 99):.1f}  max {a.max():.1f}")
+
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    conn.request('GET', '/metrics')
+    print("server metrics:", json.dumps(json.loads(conn.getresponse().read()), indent=2))
+    conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load-test the local inference server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--images', default=Config.IMAGE_DIR, help='directory of PNG/JPEG images to send')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    images = sorted(p for ext in ('png', 'jpg', 'jpeg') for p in glob.glob(os.path.join(args.images, f'*.{ext}')))
+    if not images:
+        parser.error(f'no images found in {args.images}')
+    run(args.host, args.port, images, args.requests, args.concurrency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Data-parallel submission runner with shared model weights.
+
+Test.csv is split into ``--procs`` contiguous shards, each scored by a
+forked worker running the normal submit.py pipeline into its own shard file
+(``submission.shard<k>.csv``).  When every shard is done they are merged in
+Test.csv order into ``--output``.  Shard boundaries fall on multiples of
+``--batch-size``, so every image is scored in the same batch as in a
+single-process run and the merged file is byte-identical to it, whatever
+the worker count.
+
+Weights are loaded once, in the parent, and moved to shared memory
+(``model.share_memory()``; a .safetensors checkpoint is already a shared
+file mapping).  Forked workers map the same pages instead of each holding a
+200 MB copy.  Every worker gets ``cores // procs`` intra-op threads, so
+the total matches the machine.  ONNX Runtime sessions cannot be shared
+across processes, so with ``--backend onnxruntime`` every worker opens its
+own session.
+
+All submit.py options are accepted and passed through:
+
+    python parallel_submit.py --procs 4 --fast-tiles --batch-size 2
+    python parallel_submit.py --procs 4 --resume            # same --procs as the interrupted run
+    python parallel_submit.py --scaling 1,2,4,8 --limit 64  # throughput vs worker count report
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+
+import submit
+from submit import Config
+
+# Set by the parent right before forking; workers inherit it (nothing is pickled)
+_STATE = {}
+
+
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def shard_path(output, k):
+    root, ext = os.path.splitext(output)
+    return f'{root}.shard{k}{ext}'
+
+
+def shard_indices(n_rows, procs, batch_size):
+    """Row index arrays of ``procs`` contiguous shards whose boundaries are multiples of ``batch_size``."""
+    n_batches = -(-n_rows // batch_size)
+    return [np.arange(b[0] * batch_size, min((b[-1] + 1) * batch_size, n_rows)) if len(b) else np.arange(0)
+            for b in np.array_split(np.arange(n_batches), procs)]
+
+
+def _memory_mb():
+    """(RSS, PSS) of this process in MB; PSS splits shared pages between the processes mapping them."""
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss'):
+                    values[key] = int(rest.split()[0]) / 1024
+    except OSError:
+        pass
+    return values.get('Rss', 0.0), values.get('Pss', 0.0)
+
+
+def _worker(k, threads):
+    args, shard_df = _STATE['args'], _STATE['shards'][k]
+    torch.set_num_threads(threads)
+    if args.backend == 'onnxruntime':
+        args.intra_op_threads = threads
+        backend = submit.create_backend(args)
+    else:
+        backend = _STATE['backend']
+
+    writer = submit.open_writer(args, shard_path(args.output, k))
+    todo = shard_df[~shard_df['ID'].astype(str).isin(writer.done_ids)]
+    start = time.perf_counter()
+    submit.run_pipeline(args, todo, backend, writer, progress=False)
+    rss, pss = _memory_mb()
+    return {'shard': k, 'images': len(todo), 'seconds': time.perf_counter() - start, 'rss_mb': rss, 'pss_mb': pss}
+
+
+def merge_shards(output, shard_paths, ids):
+    """Write the shard rows to ``output`` in ``ids`` order (atomically); returns the row count."""
+    jsonl = output.endswith('.jsonl')
+    header, lines = None, {}
+    for path in shard_paths:
+        with open(path, newline='') as f:
+            if not jsonl:
+                header = f.readline() or header
+            for line in f:
+                image_id = json.loads(line)['ID'] if jsonl else next(csv.reader([line]))[0]
+                lines[str(image_id)] = line
+    missing = [i for i in ids if str(i) not in lines]
+    if missing:
+        raise RuntimeError(f"{len(missing)} IDs missing from the shards, e.g. {missing[:3]}")
+    with open(output + '.tmp', 'w', newline='') as f:
+        if header:
+            f.write(header)
+        f.writelines(lines[str(i)] for i in ids)
+    os.replace(output + '.tmp', output)
+    return len(ids)
+
+
+def run(args, test_df, procs, threads):
+    """Score ``test_df`` with ``procs`` forked workers; returns per-worker stats and wall time."""
+    _STATE['args'] = args
+    _STATE['shards'] = [test_df.iloc[idx] for idx in shard_indices(len(test_df), procs, args.batch_size)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=procs, mp_context=mp.get_context('fork')) as pool:
+        stats = list(pool.map(_worker, range(procs), [threads] * procs))
+    paths = [shard_path(args.output, k) for k in range(procs)]
+    merge_shards(args.output, paths, test_df['ID'].tolist())
+    wall = time.perf_counter() - start
+    if not args.keep_shards:
+        for path in paths:
+            os.remove(path)
+    return stats, wall
+
+
+def load_shared_backend(args):
+    """Load the torch backend once in the parent with its weights in shared memory."""
+    if args.backend != 'torch':
+        return None
+    # The parent only loads; a single-threaded parent leaves no OpenMP pool behind to break in forked children
+    torch.set_num_threads(1)
+    backend = submit.create_backend(args)
+    if not args.checkpoint.endswith('.safetensors'):
+        backend.model.share_memory()
+    return backend
+
+
+def scaling_report(args, test_df, worker_counts, cores):
+    """Run the same images at every worker count and print throughput / memory per setting."""
+    print(f"{len(test_df)} images, {cores} cores")
+    print(f"{'procs':>5} {'thr/proc':>8} {'wall s':>8} {'img/s':>8} {'speedup':>8} {'eff':>6} {'sum PSS MB':>11}")
+    base = None
+    output = args.output
+    with tempfile.TemporaryDirectory() as tmp:
+        for procs in worker_counts:
+            threads = args.threads_per_proc or max(1, cores // procs)
+            args.output = os.path.join(tmp, f'scaling_{procs}' + os.path.splitext(output)[1])
+            stats, wall = run(args, test_df, procs, threads)
+            ips = len(test_df) / wall
+            base = base or ips
+            parent_pss = _memory_mb()[1]
+            total_pss = parent_pss + sum(s['pss_mb'] for s in stats)
+            print(f"{procs:>5} {threads:>8} {wall:>8.1f} {ips:>8.2f} {ips / base:>7.2f}x "
+                  f"{ips / base / procs:>6.0%} {total_pss:>11.0f}")
+            if procs == worker_counts[-1]:
+                shutil.copy(args.output, output)
+    args.output = output
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Shard Test.csv over worker processes sharing one model',
+                                     epilog='Other options are passed to submit.py (see submit.py --help).')
+    parser.add_argument('--procs', type=int, default=0, help='worker processes (default: one per 4 cores)')
+    parser.add_argument('--threads-per-proc', type=int, default=0,
+                        help='intra-op threads per worker (default: cores // procs)')
+    parser.add_argument('--scaling', help='comma-separated worker counts: print throughput vs workers')
+    parser.add_argument('--limit', type=int, default=0, help='only score the first N rows of Test.csv')
+    parser.add_argument('--keep-shards', action='store_true', help='keep the per-worker shard files after merging')
+    own, rest = parser.parse_known_args(argv)
+    args = submit.parse_args(rest)
+    if args.feature_cache_mb or args.feature_cache_dir or args.profile:
+        parser.error('the feature cache and --profile are per process; run submit.py for those')
+    for key, value in vars(own).items():
+        setattr(args, key, value)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    submit.set_seed(Config.SEED)
+    cores = available_cores()
+    test_df = pd.read_csv(Config.TEST_CSV)
+    if args.limit:
+        test_df = test_df.iloc[:args.limit]
+
+    _STATE['backend'] = load_shared_backend(args)
+    if args.scaling:
+        scaling_report(args, test_df, [int(n) for n in args.scaling.split(',') if n], cores)
+        return
+
+    procs = args.procs or max(1, cores // 4)
+    threads = args.threads_per_proc or max(1, cores // procs)
+    print(f"Scoring {len(test_df)} images with {procs} workers x {threads} threads")
+    stats, wall = run(args, test_df, procs, threads)
+    for s in stats:
+        print(f"  shard {s['shard']}: {s['images']} images in {s['seconds']:.1f}s, "
+              f"RSS {s['rss_mb']:.0f} MB (PSS {s['pss_mb']:.0f} MB)")
+    print(f"{len(test_df) / wall:.2f} img/s, submission saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
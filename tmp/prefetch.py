@@ -0,0 +1,39 @@
+"""Ordered, bounded prefetching for the submission pipeline.
+
+Decode + tiling of upcoming images runs in background workers while the
+main thread is busy with the model forward pass.  Results are always yielded
+in input order, so the output CSV is identical to a serial run.
+"""
+
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def prefetch_map(fn, items, num_workers=2, depth=8, use_processes=False):
+    """Yield ``fn(item)`` for every item, computed ahead by background workers.
+
+    At most ``depth`` items are submitted but not yet consumed, which bounds
+    the memory held by prepared-but-unused tiles.  ``num_workers=0`` runs
+    everything inline on the caller's thread (the old serial behaviour).
+    ``use_processes`` switches from threads to worker processes; ``fn`` must
+    then be picklable (a module-level function or ``functools.partial``).
+    """
+    if num_workers <= 0:
+        for item in items:
+            yield fn(item)
+        return
+
+    executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    pool = executor_cls(max_workers=num_workers)
+    it = iter(items)
+    pending = deque(pool.submit(fn, item) for item in itertools.islice(it, max(depth, 1)))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            # Refill one slot per consumed result to keep the queue bounded
+            for item in itertools.islice(it, 1):
+                pending.append(pool.submit(fn, item))
+            yield result
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,187 @@
+"""Resolution ladder: what each tile size costs and loses in accuracy.
+
+The server scores 512px tiles, the app's model is exported at 224px, and
+nothing showed what lies in between.  This exports the checkpoint to ONNX
+at every tile size in ``--tiles`` (one graph per size, or with
+``--dynamic`` a single graph with dynamic tile height/width), then scores a
+labelled split (ID, Comment and the target columns, e.g. Train.csv) with
+each through OrtBackend and prints, per tile size:
+
+    per-column MAE of the post-processed rows (COUNT_COLS, MEASURE_COLS)
+    ORT latency per image (p50, first image excluded) and tiling time
+    peak RSS while scoring (reset before every size), model file size
+
+    python resolution_ladder.py --tiles 224,288,384,512 --limit 100
+    python resolution_ladder.py --tiles 224,320,512 --dynamic --max-count-mae 1.5
+
+With ``--max-count-mae`` the fastest size whose mean count MAE meets the bar
+is reported.  A dynamic graph is traced at one size and is only exact at
+multiples of the backbone stride (32), so other sizes are rejected.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from submit import Config
+
+BACKBONE_STRIDE = 32
+
+
+def export_ladder(tile_sizes, out_dir, base, m_stats, dynamic=False):
+    """ONNX path per tile size: one export per size, or one dynamic-H/W export shared by all."""
+    from convert_onnx import export
+
+    os.makedirs(out_dir, exist_ok=True)
+    if dynamic:
+        path = export(tile=min(tile_sizes), out_path=os.path.join(out_dir, 'model_dynamic.onnx'), base=base,
+                      m_stats=m_stats, dynamic_hw=True, dummy_tiles=2)
+        return {tile: path for tile in tile_sizes}
+    return {tile: export(tile=tile, out_path=os.path.join(out_dir, f'model_t{tile}.onnx'), base=base,
+                         m_stats=m_stats, dummy_tiles=2)
+            for tile in tile_sizes}
+
+
+def _reset_peak_rss():
+    """Reset VmHWM (Linux >= 4.0); False where that is not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rss_mb():
+    """(current, peak) RSS of this process in MB."""
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS', 'VmHWM')):
+                values[line.split(':')[0]] = int(line.split()[1]) / 1024
+    return values.get('VmRSS', 0.0), values.get('VmHWM', 0.0)
+
+
+def evaluate(onnx_path, tile_size, labels_df, m_stats=None, fast_tiles=False, threads=0):
+    """Score ``labels_df`` with one model at one tile size; returns MAE per column, latency and memory."""
+    import pandas as pd
+    from backends import OrtBackend
+    from submit import load_tiles, load_tiles_vectorized, postprocess, rice_type_index
+
+    if fast_tiles:
+        tile_fn = lambda i: load_tiles_vectorized(i, tile_size)   # noqa: E731
+    else:
+        import albumentations as A
+        from albumentations.pytorch import ToTensorV2
+        transform = A.Compose([A.Resize(tile_size, tile_size), A.Normalize(), ToTensorV2()])
+        tile_fn = lambda i: load_tiles(i, transform)   # noqa: E731
+
+    peak_reset = _reset_peak_rss()
+    backend = OrtBackend(onnx_path, intra_op_threads=threads, tile_size=tile_size)
+    m_stats = backend.m_stats if backend.m_stats is not None else m_stats
+    rows, run_ms, tile_ms = [], [], []
+    for image_id, comment in zip(labels_df['ID'], labels_df['Comment']):
+        t0 = time.perf_counter()
+        tiles = tile_fn(image_id)
+        t1 = time.perf_counter()
+        rice_type = rice_type_index(comment)
+        p_c, p_m = backend.predict([tiles], [rice_type])
+        t2 = time.perf_counter()
+        tile_ms.append((t1 - t0) * 1e3)
+        run_ms.append((t2 - t1) * 1e3)
+        rows.append(postprocess(image_id, p_c[0], p_m[0], rice_type, m_stats))
+    rss, peak = _rss_mb()
+    del backend
+
+    preds = pd.DataFrame(rows).set_index('ID')
+    labels = labels_df.set_index('ID')
+    cols = [c for c in Config.COUNT_COLS + Config.MEASURE_COLS if c in labels.columns]
+    steady = run_ms[1:] or run_ms
+    return {
+        'mae': {c: float((preds[c] - labels[c]).abs().mean()) for c in cols},
+        'latency_ms': float(np.median(steady)),
+        'first_ms': run_ms[0],
+        'tiling_ms': float(np.median(tile_ms)),
+        'peak_rss_mb': peak if peak_reset else float('nan'),
+        'model_mb': os.path.getsize(onnx_path) / 1e6,
+    }
+
+
+def print_ladder(results, max_count_mae=None):
+    """Table with one column per tile size; optionally the fastest size meeting the count MAE bar."""
+    tiles = sorted(results)
+    cols = list(results[tiles[0]]['mae'])
+    print(f"\n{'':<24}" + ''.join(f"{f'{t}px':>10}" for t in tiles))
+    for col in cols:
+        print(f"{col + ' MAE':<24}" + ''.join(f"{results[t]['mae'][col]:>10.4f}" for t in tiles))
+    count_cols = [c for c in cols if c in Config.COUNT_COLS]
+    mean_count = {t: float(np.mean([results[t]['mae'][c] for c in count_cols])) if count_cols else float('nan')
+                  for t in tiles}
+    print(f"{'mean count MAE':<24}" + ''.join(f"{mean_count[t]:>10.4f}" for t in tiles))
+    for key, label, fmt in (('latency_ms', 'ORT ms/image (p50)', '.0f'), ('first_ms', 'first image ms', '.0f'),
+                            ('tiling_ms', 'tiling ms/image', '.0f'), ('peak_rss_mb', 'peak RSS MB', '.0f'),
+                            ('model_mb', 'model MB', '.1f')):
+        print(f"{label:<24}" + ''.join(f"{results[t][key]:>10{fmt}}" for t in tiles))
+
+    if max_count_mae is not None:
+        ok = [t for t in tiles if mean_count[t] <= max_count_mae]
+        if ok:
+            best = min(ok, key=lambda t: results[t]['latency_ms'] + results[t]['tiling_ms'])
+            print(f"\nFastest tile size with mean count MAE <= {max_count_mae:g}: {best}px")
+        else:
+            print(f"\nNo tile size reaches mean count MAE <= {max_count_mae:g}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Export the model at several tile sizes and compare speed/accuracy')
+    parser.add_argument('--tiles', default='224,320,384,512', help='comma-separated tile sizes')
+    parser.add_argument('--dynamic', action='store_true', help='one graph with dynamic tile height/width')
+    parser.add_argument('--labels', default=Config.TRAIN_CSV,
+                        help='CSV with ID, Comment and target columns (images from Config.IMAGE_DIR)')
+    parser.add_argument('--limit', type=int, default=0, help='only use the first N rows')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT)
+    parser.add_argument('--out-dir', default=os.path.join(Config.SCRIPT_DIR, 'ladder'),
+                        help='where the exported graphs are written')
+    parser.add_argument('--skip-export', action='store_true', help='reuse the graphs already in --out-dir')
+    parser.add_argument('--fast-tiles', action='store_true')
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--max-count-mae', type=float, help='report the fastest size meeting this mean count MAE')
+    args = parser.parse_args(argv)
+    args.tiles = sorted({int(t) for t in args.tiles.split(',') if t})
+    if args.dynamic and any(t % BACKBONE_STRIDE for t in args.tiles):
+        parser.error(f'--dynamic needs tile sizes that are multiples of {BACKBONE_STRIDE}')
+    return args
+
+
+def main(argv=None):
+    import pandas as pd
+    from submit import load_m_stats, load_model
+
+    args = parse_args(argv)
+    labels_df = pd.read_csv(args.labels)
+    if args.limit:
+        labels_df = labels_df.iloc[:args.limit]
+    if not any(c in labels_df.columns for c in Config.COUNT_COLS + Config.MEASURE_COLS):
+        raise SystemExit(f"{args.labels} has none of the target columns")
+
+    if args.skip_export:
+        names = {t: 'model_dynamic.onnx' if args.dynamic else f'model_t{t}.onnx' for t in args.tiles}
+        paths = {t: os.path.join(args.out_dir, name) for t, name in names.items()}
+        m_stats = load_m_stats(args.checkpoint)
+    else:
+        model, m_stats = load_model(args.checkpoint)
+        paths = export_ladder(args.tiles, args.out_dir, model, m_stats, dynamic=args.dynamic)
+        del model
+
+    results = {}
+    for tile in args.tiles:
+        print(f"Scoring {len(labels_df)} images at {tile}px ({os.path.basename(paths[tile])}) …")
+        results[tile] = evaluate(paths[tile], tile, labels_df, m_stats, fast_tiles=args.fast_tiles,
+                                 threads=args.intra_op_threads)
+    print_ladder(results, args.max_count_mae)
+
+
+if __name__ == '__main__':
+    main()
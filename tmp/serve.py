@@ -0,0 +1,315 @@
+"""Local inference server with dynamic micro-batching for the mobile app.
+
+Phones can offload a scan instead of running all 48 tiles on-device.  The
+request body is the raw image (PNG/JPEG), the rice type is a query
+parameter, and the response is the post-processed submission row as JSON:
+
+    POST /predict?rice_type=White     -> {"ID": ..., "Count": ..., ..., "Average_b": ...}
+    GET  /metrics                     -> queue depth, batch sizes, latency percentiles
+    GET  /healthz
+
+Requests that arrive together are coalesced by MicroBatcher into one
+``backend.predict`` call of up to ``--max-batch`` images.  The batcher waits
+at most ``--max-wait-ms`` after the first request for others to join.  When
+``--max-queue`` requests are already waiting, new ones get 503 with
+Retry-After instead of piling up latency (backpressure).
+
+Only the torch backend turns a coalesced batch into one batched forward.
+``--backend onnxruntime`` runs the MobileWrapper graph one image at a time
+(OrtBackend.predict), so a batch of N is still N session runs: coalescing
+only saves queueing and dispatch there, not forward passes.
+
+Decoding and tiling run in a thread pool and the forward pass in a single
+inference thread, so the event loop keeps accepting connections while a
+batch runs.  Everything is stdlib asyncio; load_test.py drives it locally.
+
+    python serve.py --port 8000 --max-batch 8 --max-wait-ms 10
+    python serve.py --backend onnxruntime --onnx-model model_mobile.onnx
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+from submit import Config, check_args, create_backend, postprocess
+from tiling import tile_tensor
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY = 64 * 2**20
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Metrics:
+    """Rolling request/batch statistics over the last ``window`` requests."""
+
+    def __init__(self, window=1000):
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.batches = 0
+        self.latency_ms = deque(maxlen=window)      # arrival -> response
+        self.queue_wait_ms = deque(maxlen=window)   # enqueue -> batch start
+        self.batch_sizes = deque(maxlen=window)
+
+    def snapshot(self, queue_depth):
+        def pct(values):
+            if not values:
+                return {}
+            a = np.asarray(values)
+            return {f'p{q}': float(np.percentile(a, q)) for q in (50, 95, 99)} | {'mean': float(a.mean())}
+
+        return {
+            'uptime_s': time.time() - self.started,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'batches': self.batches,
+            'queue_depth': queue_depth,
+            'batch_size': pct(self.batch_sizes),
+            'latency_ms': pct(self.latency_ms),
+            'queue_wait_ms': pct(self.queue_wait_ms),
+        }
+
+
+class MicroBatcher:
+    """Coalesce concurrent ``predict`` calls into batched ``backend.predict`` calls.
+
+    A batched call is one forward pass with the torch backend; OrtBackend loops over the images.
+    """
+
+    def __init__(self, backend, max_batch=8, max_wait_ms=10.0, max_queue=64, metrics=None):
+        self.backend = backend
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1e3
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.metrics = metrics or Metrics()
+        # One inference thread: batches run back to back, never concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='infer')
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def predict(self, tiles, rice_type):
+        """Raw (counts, measures) for one image; raises QueueFull when the queue is at capacity."""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((tiles, rice_type, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise QueueFull from None
+        return await future
+
+    async def _collect(self):
+        """Block for one request, then take more until max_batch or the max_wait deadline."""
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            self.metrics.batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+            self.metrics.queue_wait_ms.extend((start - item[3]) * 1e3 for item in batch)
+            try:
+                p_c, p_m = await loop.run_in_executor(
+                    self._executor, self.backend.predict, [item[0] for item in batch], [item[1] for item in batch])
+            except Exception as e:
+                for item in batch:
+                    if not item[2].done():
+                        item[2].set_exception(e)
+                continue
+            for i, item in enumerate(batch):
+                if not item[2].done():   # client may have gone away
+                    item[2].set_result((p_c[i], p_m[i]))
+
+
+class InferenceServer:
+    def __init__(self, backend, max_batch=8, max_wait_ms=10.0, max_queue=64, preprocess_workers=2):
+        self.backend = backend
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(backend, max_batch, max_wait_ms, max_queue, self.metrics)
+        self._preprocess = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix='tiles')
+
+    def load_tiles(self, data):
+        """Decode image bytes and tile them like submit.py --fast-tiles."""
+        image = np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+        return tile_tensor(image, self.backend.tile_size, Config.GRID_ROWS, Config.GRID_COLS)
+
+    async def handle_predict(self, query, body):
+        rice_name = query.get('rice_type', ['Paddy'])[0]
+        if rice_name not in Config.RICE_TYPES:
+            return 400, {'error': f"rice_type must be one of {list(Config.RICE_TYPES)}"}
+        if not body:
+            return 400, {'error': 'empty body, expected PNG/JPEG image bytes'}
+        rice_type = Config.RICE_TYPES[rice_name]
+        try:
+            tiles = await asyncio.get_running_loop().run_in_executor(self._preprocess, self.load_tiles, body)
+        except Exception as e:
+            return 400, {'error': f'could not decode image: {e}'}
+        p_c, p_m = await self.batcher.predict(tiles, rice_type)
+        row = postprocess(query.get('id', [''])[0], p_c, p_m, rice_type, self.backend.m_stats)
+        return 200, {k: (float(v) if isinstance(v, np.floating) else v) for k, v in row.items()}
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        if url.path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            return await self.handle_predict(parse_qs(url.query), body)
+        if url.path == '/metrics':
+            return 200, self.metrics.snapshot(self.batcher.queue.qsize())
+        if url.path == '/healthz':
+            return 200, {'status': 'ok', 'backend': self.backend.name}
+        return 404, {'error': f'unknown path {url.path}'}
+
+    async def handle_connection(self, reader, writer):
+        """Minimal HTTP/1.1 with keep-alive: one request at a time per connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    await self._respond(writer, 400, {'error': 'malformed request line'}, close=True)
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {'error': 'invalid Content-Length'}, close=True)
+                    break
+                close = headers.get('connection', '').lower() == 'close'
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {'error': 'body too large'}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                arrived = time.perf_counter()
+                self.metrics.requests += 1
+                extra = {}
+                try:
+                    status, payload = await self.dispatch(method, target, body)
+                except QueueFull:
+                    self.metrics.rejected += 1
+                    status, payload = 503, {'error': 'inference queue full, retry later'}
+                    extra['Retry-After'] = '1'
+                except Exception as e:
+                    self.metrics.errors += 1
+                    status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+                if status == 200 and method == 'POST':
+                    self.metrics.latency_ms.append((time.perf_counter() - arrived) * 1e3)
+                await self._respond(writer, status, payload, close=close, headers=extra)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status, payload, close=False, headers=None):
+        body = json.dumps(payload).encode()
+        head = [f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "")}',
+                'Content-Type: application/json',
+                f'Content-Length: {len(body)}',
+                f'Connection: {"close" if close else "keep-alive"}']
+        head += [f'{k}: {v}' for k, v in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {self.backend.name} backend on http://{host}:{port} "
+              f"(max batch {self.batcher.max_batch}, max wait {self.batcher.max_wait * 1e3:g} ms, "
+              f"queue {self.batcher.queue.maxsize})", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+            self._preprocess.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Local micro-batching inference server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=8,
+                        help='most images coalesced into one forward pass (torch; onnxruntime still runs '
+                             'one session per image)')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help='how long the first request of a batch waits for others to join')
+    parser.add_argument('--max-queue', type=int, default=64,
+                        help='waiting requests before new ones are rejected with 503')
+    parser.add_argument('--preprocess-workers', type=int, default=Config.NUM_WORKERS,
+                        help='threads decoding and tiling request images')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT, help='.pth or .safetensors (fast_checkpoint.py)')
+    parser.add_argument('--backend', choices=['torch', 'onnxruntime'], default='torch')
+    parser.add_argument('--onnx-model', default=Config.ONNX_MODEL)
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--fused-heads', action='store_true')
+    parser.add_argument('--skip-zero-heads', action='store_true')
+    parser.add_argument('--tile-chunk', type=int, default=Config.TILE_CHUNK)
+    parser.add_argument('--tile-filter', choices=['foreground', 'std'])
+    parser.add_argument('--tile-filter-threshold', type=float)
+    parser.add_argument('--fast-cpu', action='store_true')
+    parser.add_argument('--bf16', action='store_true')
+    parser.add_argument('--compile', choices=['none', 'script', 'inductor'], default='none')
+    parser.add_argument('--compile-cache', default=Config.COMPILE_CACHE)
+    args = parser.parse_args(argv)
+    check_args(parser, args)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backend = create_backend(args)
+    server = InferenceServer(backend, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms,
+                             max_queue=args.max_queue, preprocess_workers=args.preprocess_workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
 
 import os
 import random
+import argparse
+from functools import partial
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import timm
 from PIL import Image
-import albumentations as A
-from albumentations.pytorch import ToTensorV2
-from tqdm import tqdm
+# pandas, timm, albumentations, tqdm and tiling (cv2) are imported where they are used, so
+# importing this module (serve.py, workers, convert_onnx.py) does not pay for them up front
+
+import profiling
+from prefetch import prefetch_map
+from result_writer import ResultWriter
+from fused_decoder import FusedCSRDecoder, fuse_count_heads_state_dict
 
 # Constants from training script
 class Config:
@@ -19,7 +23,9 @@ class Config:
     DATA_DIR = os.path.join(SCRIPT_DIR, 'Data')
     IMAGE_DIR = os.path.join(DATA_DIR, 'images', 'images')
     TEST_CSV = os.path.join(DATA_DIR, 'Test.csv')
+    TRAIN_CSV = os.path.join(DATA_DIR, 'Train.csv')
     CHECKPOINT = 'ultimate_tiled_multitask.pth'
+    ONNX_MODEL = os.path.join(SCRIPT_DIR, 'model_mobile.onnx')
     
     MODEL_NAME = 'convnext_small.fb_in22k_ft_in1k_384'
     TILE_SIZE = 512
@@ -35,19 +41,39 @@ class Config:
     PADDY_ZERO = ['Chalky_Count', 'Medium_Count', 'Yellow_Count', 'Green_Count']
     BROWN_ZERO = ['Green_Count']
     
+    RICE_TYPES = {'Paddy': 0, 'White': 1, 'Brown': 2}
+    N_COUNTS = len(COUNT_COLS)
+    
     SCALE = 100.0
+    BATCH_SIZE = 1      # images per forward pass; >1 is opt-in (B*N_TILES tiles in memory, ~1e-8 drift)
+    NUM_WORKERS = 2     # background decode/tiling workers (0 = serial)
+    PREFETCH = 8        # images prepared ahead of the model
+    OUTPUT = 'submission.csv'
+    FSYNC_EVERY = 100   # rows between fsync checkpoints of the output
+    TILE_CHUNK = 0      # tiles per backbone pass (0 = all B*N tiles at once)
+    COMPILE_CACHE = os.path.join(SCRIPT_DIR, '.compile_cache')   # frozen graphs for --fast-cpu --compile
     DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     SEED = 42
 
+def zero_count_cols(rice_type):
+    """Count columns that are always 0 for a rice type index (known class constraints)."""
+    return {0: Config.PADDY_ZERO, 2: Config.BROWN_ZERO}.get(rice_type, [])
+
+def live_count_heads(rice_type):
+    """Indices of the count heads whose output survives post-processing for a rice type."""
+    zero = zero_count_cols(rice_type)
+    return [k for k, col in enumerate(Config.COUNT_COLS) if col not in zero]
+
 def set_seed(seed):
     """Set random seeds and deterministic flags for reproducible inference."""
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
 
 class MultiScaleCSRDecoder(nn.Module):
     def __init__(self, in_channels_list):
@@ -79,42 +105,157 @@ class MultiScaleCSRDecoder(nn.Module):
         return self.backend(combined)
 
 class UltimateSpecialist(nn.Module):
-    def __init__(self, model_name):
+    def __init__(self, model_name, fused_heads=False):
         super().__init__()
-        self.backbone = timm.create_model(model_name, pretrained=False, features_only=True)
+        # Only the 1/16 and 1/32 stages are used; later stages (none for ConvNeXt) are not built and
+        # earlier feature maps are not returned, so they can be freed as soon as the next stage ran
+        import timm
+
+        self.backbone = timm.create_model(model_name, pretrained=False, features_only=True, out_indices=(-2, -1))
         ch_list = self.backbone.feature_info.channels()
         self.meta_proj = nn.Sequential(nn.Linear(3, 32), nn.LayerNorm(32), nn.GELU())
-        self.count_heads = nn.ModuleList([MultiScaleCSRDecoder(ch_list) for _ in range(9)])
+        # fused_heads: one FusedCSRDecoder emitting all 9 maps (load weights via fuse_count_heads_state_dict)
+        if fused_heads:
+            self.count_heads = FusedCSRDecoder(ch_list, n_heads=9)
+        else:
+            self.count_heads = nn.ModuleList([MultiScaleCSRDecoder(ch_list) for _ in range(9)])
         self.measure_head = nn.Sequential(
             nn.Linear(ch_list[-1] + 32, 256), nn.GELU(), nn.Dropout(0.2),
             nn.Linear(256, 6)
         )
 
-    def forward(self, x, meta):
-        """Run tiled inference and return count and measure predictions."""
+    def forward(self, x, meta, skip_zero_heads=False, tile_chunk=0, tile_mask=None):
+        """Run tiled inference and return count and measure predictions.
+
+        With ``skip_zero_heads`` the count heads that post-processing zeroes
+        for a sample's rice type are not evaluated and come back as 0.
+        ``tile_chunk`` bounds how many tiles go through the backbone at once
+        (see forward_chunked); 0 runs all B*N tiles in one pass.
+        ``tile_mask`` (B, N) bool, e.g. from tile_filter.TileFilter, skips
+        the masked-out tiles entirely.
+        """
+        B, N = x.shape[:2]
+        if tile_mask is not None:
+            return self.forward_chunked(x, meta, tile_chunk or B * N, skip_zero_heads=skip_zero_heads,
+                                        tile_mask=tile_mask)
+        if 0 < tile_chunk < B * N:
+            return self.forward_chunked(x, meta, tile_chunk, skip_zero_heads=skip_zero_heads)
+        f16, f32 = self.extract_features(x)
+        return self.decode(f16, f32, meta, B, N, skip_zero_heads=skip_zero_heads)
+
+    def extract_features(self, x):
+        """Backbone pass over all tiles: (B, N, C, H, W) -> (f16, f32), each (B*N, C', h, w)."""
         B, N, C, H_in, W_in = x.shape
         x_flat = x.view(B*N, C, H_in, W_in)
-        all_feats = self.backbone(x_flat)
-        f16 = all_feats[-2]
-        f32 = all_feats[-1]
+        with profiling.stage('backbone', tiles=B*N):
+            all_feats = self.backbone(x_flat)
+        return all_feats[-2], all_feats[-1]
+
+    def decode(self, f16, f32, meta, B, N, skip_zero_heads=False):
+        """Meta projection, count heads and measure head on precomputed backbone features."""
         m = self.meta_proj(meta)
         m_flat = m.repeat_interleave(N, dim=0)
         bh16, bw16 = f16.shape[2:]
         m_map16 = m_flat.view(B*N, 32, 1, 1).expand(-1, -1, bh16, bw16)
         
+        with profiling.stage('count_heads', images=B):
+            if skip_zero_heads:
+                counts = self._live_head_counts(f16, f32, m_map16, meta, B, N)
+            else:
+                counts = self._head_counts(f16, f32, m_map16, B, N)
+        with profiling.stage('measure_head', images=B):
+            m_map32 = m_flat.view(B*N, 32, 1, 1).expand(-1, -1, f32.shape[2], f32.shape[3])
+            combined32 = torch.cat([f32, m_map32], dim=1)
+            pool = F.adaptive_avg_pool2d(combined32, 1).view(B, N, -1).mean(dim=1)
+            measures = self.measure_head(pool)
+        return counts, measures
+
+    def forward_chunked(self, x, meta, tile_chunk, skip_zero_heads=False, tile_mask=None):
+        """Same outputs as forward, with only ``tile_chunk`` tiles' activations alive at a time.
+
+        Counts are sums over tiles and the measure head sees the mean of the
+        pooled ``combined32`` over tiles, so each chunk only has to leave
+        behind its per-tile head sums (B*N, 9) and pooled features
+        (B*N, C+32); both are reduced over tiles exactly as in decode.
+        With ``tile_mask`` only the kept tiles are run: the others count 0
+        and the mean for the measure head is over the kept tiles only.
+        """
+        B, N, C, H_in, W_in = x.shape
+        x_flat = x.view(B*N, C, H_in, W_in)
+        m_flat = self.meta_proj(meta).repeat_interleave(N, dim=0)
+        tile_types = meta.argmax(dim=1).repeat_interleave(N)
+        tile_counts = x.new_zeros(B*N, Config.N_COUNTS)
+        kept = None if tile_mask is None else tile_mask.flatten().nonzero().flatten()
+        n_run = B*N if kept is None else len(kept)
+        pooled = []
+        for start in range(0, n_run, tile_chunk):
+            chunk = slice(start, start + tile_chunk) if kept is None else kept[start:start + tile_chunk]
+            xc = x_flat[chunk]   # a view for slices, one gather copy for the kept-tile index
+            with profiling.stage('backbone', tiles=xc.shape[0]):
+                f16, f32 = self.backbone(xc)
+            m = m_flat[chunk].view(-1, 32, 1, 1)
+            m_map16 = m.expand(-1, -1, f16.shape[2], f16.shape[3])
+            with profiling.stage('count_heads', tiles=f16.shape[0]):
+                if skip_zero_heads:
+                    chunk_types = tile_types[chunk]
+                    for rice_type in chunk_types.unique().tolist():
+                        rows = (chunk_types == rice_type).nonzero().flatten()
+                        live = live_count_heads(rice_type)
+                        tile_rows = start + rows if kept is None else chunk[rows]
+                        tile_counts[tile_rows.unsqueeze(1), torch.as_tensor(live, device=x.device)] = \
+                            self._tile_head_sums(f16[rows], f32[rows], m_map16[rows], heads=live)
+                else:
+                    tile_counts[chunk] = self._tile_head_sums(f16, f32, m_map16)
+            with profiling.stage('measure_head', tiles=f16.shape[0]):
+                combined32 = torch.cat([f32, m.expand(-1, -1, f32.shape[2], f32.shape[3])], dim=1)
+                pooled.append(F.adaptive_avg_pool2d(combined32, 1).flatten(1))
+            del xc, f16, f32, m_map16, combined32
+
+        counts = tile_counts.view(B, N, -1).sum(dim=1)
+        if kept is None:
+            pool = torch.cat(pooled).view(B, N, -1).mean(dim=1)
+        else:
+            pooled_all = x.new_zeros(B*N, pooled[0].shape[1])
+            pooled_all[kept] = torch.cat(pooled)
+            pool = pooled_all.view(B, N, -1).sum(dim=1) / tile_mask.sum(dim=1, keepdim=True).to(x.dtype)
+        return counts, self.measure_head(pool)
+
+    def _tile_head_sums(self, f16, f32, m_map16, heads=None):
+        """Per-tile density sums, (tiles, len(heads)); all 9 heads by default."""
+        if isinstance(self.count_heads, FusedCSRDecoder):
+            return F.relu(self.count_heads(f16, f32, m_map16, heads=heads)).sum(dim=(2,3))
+        heads = range(len(self.count_heads)) if heads is None else heads
+        return torch.stack([F.relu(self.count_heads[k](f16, f32, m_map16)).sum(dim=(1,2,3)) for k in heads], dim=1)
+
+    def _head_counts(self, f16, f32, m_map16, B, N, heads=None):
+        """Density sums over the N tiles of each image, (B, len(heads)); all 9 heads by default."""
+        if isinstance(self.count_heads, FusedCSRDecoder):
+            d = F.relu(self.count_heads(f16, f32, m_map16, heads=heads))
+            return d.sum(dim=(2,3)).view(B, N, -1).sum(dim=1) # Sum N tiles -> (B, heads)
+
         tile_densities = []
-        for head in self.count_heads:
-            d = F.relu(head(f16, f32, m_map16))
+        for k in (range(len(self.count_heads)) if heads is None else heads):
+            d = F.relu(self.count_heads[k](f16, f32, m_map16))
             tile_sum = d.sum(dim=(1,2,3)).view(B, N)
             tile_sum = tile_sum.sum(dim=1).unsqueeze(1) # Sum N tiles -> (B, 1)
             tile_densities.append(tile_sum)
-        
-        counts = torch.cat(tile_densities, dim=1)
-        m_map32 = m_flat.view(B*N, 32, 1, 1).expand(-1, -1, f32.shape[2], f32.shape[3])
-        combined32 = torch.cat([f32, m_map32], dim=1)
-        pool = F.adaptive_avg_pool2d(combined32, 1).view(B, N, -1).mean(dim=1)
-        measures = self.measure_head(pool)
-        return counts, measures
+        return torch.cat(tile_densities, dim=1)
+
+    def _live_head_counts(self, f16, f32, m_map16, meta, B, N):
+        """Like _head_counts, but each rice-type group only runs the heads that survive post-processing."""
+        counts = f16.new_zeros(B, Config.N_COUNTS)
+        rice_types = meta.argmax(dim=1)
+        for rice_type in rice_types.unique().tolist():
+            samples = (rice_types == rice_type).nonzero().flatten()
+            live = live_count_heads(rice_type)
+            if len(samples) == B:
+                counts[:, live] = self._head_counts(f16, f32, m_map16, B, N, heads=live)
+                continue
+            # Tiles of the samples in this group, in sample-major order
+            tiles = (samples.unsqueeze(1) * N + torch.arange(N, device=samples.device)).flatten()
+            counts[samples.unsqueeze(1), torch.as_tensor(live, device=samples.device)] = self._head_counts(
+                f16[tiles], f32[tiles], m_map16[tiles], len(samples), N, heads=live)
+        return counts
 
 def get_tiles(image):
     """Split an image into a fixed 8x6 grid of tiles."""
@@ -131,59 +272,324 @@ def get_tiles(image):
             tiles.append(image[y1:y2, x1:x2])
     return tiles
 
-def main():
-    """Load checkpoint, run inference on test data, and write submission CSV."""
-    set_seed(Config.SEED)
-    checkpoint = torch.load(Config.CHECKPOINT, map_location='cpu', weights_only=False)
-    model = UltimateSpecialist(Config.MODEL_NAME)
-    model.load_state_dict(checkpoint['model'])
+def load_model(checkpoint_path=None, fused_heads=False):
+    """Build the model, load checkpoint weights and return (model, m_stats).
+
+    A ``.safetensors`` path (see fast_checkpoint.py) is memory-mapped instead
+    of unpickled.
+    """
+    checkpoint_path = checkpoint_path or Config.CHECKPOINT
+    if checkpoint_path.endswith('.safetensors'):
+        from fast_checkpoint import load_fast
+        model, m_stats = load_fast(checkpoint_path, fused_heads=fused_heads)
+        return model.to(Config.DEVICE), m_stats
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    model = UltimateSpecialist(Config.MODEL_NAME, fused_heads=fused_heads)
+    state_dict = checkpoint['model']
+    if fused_heads:
+        state_dict = fuse_count_heads_state_dict(state_dict)
+    model.load_state_dict(state_dict)
     model.to(Config.DEVICE)
     model.eval()
+    return model, checkpoint['m_stats']
+
+def load_m_stats(checkpoint_path=None):
+    """Measure normalisation stats (mean, std) stored with a checkpoint."""
+    checkpoint_path = checkpoint_path or Config.CHECKPOINT
+    if checkpoint_path.endswith('.safetensors'):
+        from fast_checkpoint import load_m_stats as load_sidecar_m_stats
+        return load_sidecar_m_stats(checkpoint_path)
+    return torch.load(checkpoint_path, map_location='cpu', weights_only=False)['m_stats']
+
+def rice_type_index(comment):
+    """Map a Test.csv ``Comment`` value to its one-hot meta index (unknown -> Paddy)."""
+    return Config.RICE_TYPES.get(comment, 0)
+
+def build_meta(rice_types):
+    """One-hot rice-type meta of shape (B, 3) for a list of rice type indices."""
+    meta = torch.zeros(len(rice_types), 3)
+    meta[torch.arange(len(rice_types)), torch.as_tensor(rice_types)] = 1.0
+    return meta
+
+def image_path(image_id):
+    return os.path.join(Config.IMAGE_DIR, f"{image_id}.png")
+
+def read_image(image_id):
+    """Decode one test image to an RGB uint8 array."""
+    with profiling.stage('decode', image=image_id):
+        return np.array(Image.open(image_path(image_id)).convert('RGB'))
+
+def load_tiles(image_id, transform):
+    """Decode one test image and return its transformed tiles as (N, C, H, W)."""
+    image = read_image(image_id)
+    with profiling.stage('get_tiles', image=image_id):
+        tiles = get_tiles(image)
+    with profiling.stage('transform', image=image_id):
+        return torch.stack([transform(image=t)['image'] for t in tiles])
+
+def load_tiles_vectorized(image_id, tile_size):
+    """Like load_tiles, but resizes the whole image once and normalizes all tiles in one op."""
+    from tiling import tile_tensor
+
+    image = read_image(image_id)
+    with profiling.stage('tile_tensor', image=image_id):
+        return tile_tensor(image, tile_size, Config.GRID_ROWS, Config.GRID_COLS)
+
+def load_tiles_stored(image_id, store, fallback):
+    """Tiles from a tile_store.TileStore; decodes the image only if it is missing or changed since."""
+    if store.is_fresh(image_id, image_path(image_id)):
+        with profiling.stage('tile_store', image=image_id):
+            return store.tiles(image_id)
+    return fallback(image_id)
+
+def load_tiles_cached(image_id, load_fn, cache, tag):
+    """Hash the raw PNG and only decode/tile it when its backbone features are not cached.
+
+    Returns (cache key, tiles or None).
+    """
+    with open(image_path(image_id), 'rb') as f:
+        key = cache.content_key(f.read(), tag)
+    return key, (None if key in cache else load_fn(image_id))
+
+def iter_batches(df, batch_size):
+    """Yield consecutive row slices of ``df`` with at most ``batch_size`` rows."""
+    for start in range(0, len(df), batch_size):
+        yield df.iloc[start:start + batch_size]
+
+def postprocess(image_id, p_c, p_m, rice_type, m_stats):
+    """Turn raw model outputs for one image into a submission row."""
+    # Undo training-time scaling/normalization for readable outputs
+    p_c = p_c / Config.SCALE
+    p_m = p_m * (m_stats[1] + 1e-8) + m_stats[0]
     
-    m_stats = checkpoint['m_stats']
-    test_df = pd.read_csv(Config.TEST_CSV)
+    # Post-processing: apply known class constraints for rice types
+    for k, col in enumerate(Config.COUNT_COLS):
+        if col in zero_count_cols(rice_type):
+            p_c[k] = 0
     
-    transform = A.Compose([A.Resize(Config.TILE_SIZE, Config.TILE_SIZE), A.Normalize(), ToTensorV2()])
+    # Round counts, keep measures as is
+    res_row = {'ID': image_id}
+    for i, col in enumerate(Config.COUNT_COLS):
+        res_row[col] = max(0, int(round(p_c[i])))
+    for i, col in enumerate(Config.MEASURE_COLS):
+        res_row[col] = p_m[i]
+    return res_row
 
-    results = []
-    
-    with torch.no_grad():
-        for _, row in tqdm(test_df.iterrows(), total=len(test_df)):
-            img_path = os.path.join(Config.IMAGE_DIR, f"{row['ID']}.png")
-            image = np.array(Image.open(img_path).convert('RGB'))
-            tiles = get_tiles(image)
-            
-            # Rice type meta
-            rice_type = {'Paddy': 0, 'White': 1, 'Brown': 2}.get(row['Comment'], 0)
-            meta = torch.zeros(1, 3).to(Config.DEVICE)
-            meta[0, rice_type] = 1.0
-            
-            processed = torch.stack([transform(image=t)['image'] for t in tiles]).unsqueeze(0).to(Config.DEVICE)
-            p_c, p_m = model(processed, meta)
-            
-            # Undo training-time scaling/normalization for readable outputs
-            p_c = p_c.cpu().numpy()[0] / Config.SCALE
-            p_m = p_m.cpu().numpy()[0] * (m_stats[1] + 1e-8) + m_stats[0]
-            
-            # Post-processing: apply known class constraints for rice types
-            for k, col in enumerate(Config.COUNT_COLS):
-                if (rice_type == 0 and col in Config.PADDY_ZERO) or (rice_type == 2 and col in Config.BROWN_ZERO):
-                    p_c[k] = 0
-            
-            # Round counts, keep measures as is
-            res_row = {'ID': row['ID']}
-            for i, col in enumerate(Config.COUNT_COLS):
-                res_row[col] = max(0, int(round(p_c[i])))
-            for i, col in enumerate(Config.MEASURE_COLS):
-                res_row[col] = p_m[i]
-                
-            results.append(res_row)
-
-    out_df = pd.DataFrame(results)
+def check_args(parser, args):
+    """Reject backend/option combinations that would be ignored or fail at predict time.
+
+    Shared by submit.py and serve.py; options a parser does not define count as unset.
+    """
+    feature_cache = getattr(args, 'feature_cache_mb', 0) or getattr(args, 'feature_cache_dir', None)
+    if args.backend != 'torch' and (args.fused_heads or args.skip_zero_heads or feature_cache
+                                    or args.tile_chunk or args.fast_cpu or args.tile_filter):
+        parser.error('--fused-heads, --skip-zero-heads, --tile-chunk, --fast-cpu, --tile-filter and the feature '
+                     'cache need --backend torch')
+    if args.tile_filter and (feature_cache or args.compile != 'none'):
+        parser.error('--tile-filter cannot be combined with the feature cache or --compile')
+    if (args.bf16 or args.compile != 'none') and not args.fast_cpu:
+        parser.error('--bf16 and --compile need --fast-cpu')
+    if args.fast_cpu and feature_cache:
+        parser.error('--fast-cpu cannot be combined with the feature cache')
+    if args.compile != 'none' and args.skip_zero_heads:
+        parser.error('--skip-zero-heads is data dependent and cannot be compiled')
+    if args.tile_chunk and feature_cache:
+        parser.error('--tile-chunk cannot be combined with the feature cache (it keeps whole-batch features)')
+    if getattr(args, 'trace', None) and not getattr(args, 'profile', False):
+        parser.error('--trace needs --profile')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run tiled inference on Test.csv and write submission.csv')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT,
+                        help='training .pth checkpoint, or a .safetensors file from fast_checkpoint.py (mmap, '
+                             'faster cold start)')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE,
+                        help='images per forward pass (each image contributes N_TILES tiles; '
+                             'bound memory with --tile-chunk when raising it)')
+    parser.add_argument('--workers', type=int, default=Config.NUM_WORKERS,
+                        help='background workers decoding and tiling upcoming images (0 = serial)')
+    parser.add_argument('--prefetch', type=int, default=Config.PREFETCH,
+                        help='maximum number of images prepared ahead of the model')
+    parser.add_argument('--worker-processes', action='store_true',
+                        help='use worker processes instead of threads for preprocessing')
+    parser.add_argument('--fast-tiles', action='store_true',
+                        help='vectorized tiling (one resize of the whole image, see tiling.py) instead of '
+                             'per-tile albumentations transforms')
+    parser.add_argument('--tile-store',
+                        help='read precomputed tiles from this tile_store.py array instead of decoding the PNGs '
+                             '(must match the tile size and --fast-tiles)')
+    parser.add_argument('--fused-heads', action='store_true',
+                        help='run the 9 count heads as one grouped-conv decoder (see fused_decoder.py)')
+    parser.add_argument('--skip-zero-heads', action='store_true',
+                        help='do not evaluate count heads that post-processing zeroes for the rice type')
+    parser.add_argument('--feature-cache-mb', type=float, default=0,
+                        help='keep backbone features of up to this many MB in an LRU cache keyed by image '
+                             'content, so re-runs with different rice types only pay for the heads (0 = off)')
+    parser.add_argument('--feature-cache-dir',
+                        help='spill features evicted from the in-memory cache to this directory and reuse them '
+                             'across runs')
+    parser.add_argument('--tile-chunk', type=int, default=Config.TILE_CHUNK,
+                        help='run the backbone on at most this many tiles at a time to bound peak memory; '
+                             'results match the all-at-once pass (0 = all tiles of the batch at once)')
+    parser.add_argument('--tile-filter', choices=['foreground', 'std'],
+                        help='skip background tiles scored below --tile-filter-threshold by this statistic '
+                             '(see tile_filter.py; check the accuracy impact with python tile_filter.py --report)')
+    parser.add_argument('--tile-filter-threshold', type=float,
+                        help='keep tiles scoring at least this (default: 0.002 foreground ratio / 4.0 grey std)')
+    parser.add_argument('--fast-cpu', action='store_true',
+                        help='channels_last + inference_mode execution (see fast_cpu.py; check drift with '
+                             'python fast_cpu.py --check)')
+    parser.add_argument('--bf16', action='store_true',
+                        help='with --fast-cpu: bfloat16 autocast, if the CPU supports it natively')
+    parser.add_argument('--compile', choices=['none', 'script', 'inductor'], default='none',
+                        help='with --fast-cpu: frozen TorchScript graph or torch.compile, cached across runs')
+    parser.add_argument('--compile-cache', default=Config.COMPILE_CACHE,
+                        help='directory for the compiled graphs of --compile')
+    parser.add_argument('--backend', choices=['torch', 'onnxruntime'], default='torch',
+                        help='eager PyTorch checkpoint or the ONNX graph exported by convert_onnx.py')
+    parser.add_argument('--onnx-model', default=Config.ONNX_MODEL,
+                        help='ONNX model for --backend onnxruntime (tile size is read from the graph); '
+                             '.opt.onnx / .ort artifacts from convert_onnx.py --ort-artifacts open faster')
+    parser.add_argument('--intra-op-threads', type=int, default=0,
+                        help='threads inside one operator (0 = library default)')
+    parser.add_argument('--inter-op-threads', type=int, default=0,
+                        help='onnxruntime: threads running independent graph nodes in parallel (0 = default)')
+    parser.add_argument('--output', default=Config.OUTPUT,
+                        help='rows are streamed here as they are produced (.jsonl for JSON lines, else CSV)')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep the rows already in --output and only run the missing IDs')
+    parser.add_argument('--fsync-every', type=int, default=Config.FSYNC_EVERY,
+                        help='flush and fsync the output after this many rows')
+    parser.add_argument('--profile', action='store_true',
+                        help='time every pipeline stage and print a per-stage summary (see profiling.py)')
+    parser.add_argument('--trace',
+                        help='with --profile: also write a Chrome trace (chrome://tracing, Perfetto) to this file')
+    args = parser.parse_args(argv)
+    check_args(parser, args)
+    return args
+
+def create_backend(args, cache=None):
+    """Instantiate the inference backend selected on the command line."""
+    from backends import OrtBackend, TorchBackend
+
+    if args.backend == 'onnxruntime':
+        backend = OrtBackend(args.onnx_model, intra_op_threads=args.intra_op_threads,
+                             inter_op_threads=args.inter_op_threads)
+        if backend.m_stats is None:
+            # Older exports without metadata: take m_stats from the checkpoint
+            backend.m_stats = load_m_stats(args.checkpoint)
+        return backend
+    model, m_stats = load_model(args.checkpoint, fused_heads=args.fused_heads)
+    tile_filter = None
+    if args.tile_filter:
+        from tile_filter import TileFilter
+        tile_filter = TileFilter(args.tile_filter, threshold=args.tile_filter_threshold)
+    runner = None
+    if args.fast_cpu:
+        from fast_cpu import FastCPUModel, weights_tag
+        runner = FastCPUModel(model, bf16=args.bf16, compile=args.compile, cache_dir=args.compile_cache,
+                              cache_tag=weights_tag(args.checkpoint, args.fused_heads),
+                              skip_zero_heads=args.skip_zero_heads, tile_chunk=args.tile_chunk)
+    return TorchBackend(model, m_stats, skip_zero_heads=args.skip_zero_heads, cache=cache,
+                        threads=args.intra_op_threads, tile_chunk=args.tile_chunk, runner=runner,
+                        tile_filter=tile_filter)
+
+def open_writer(args, output=None):
+    """ResultWriter for the submission columns; with --resume, already written IDs are in ``done_ids``."""
     cols = ['ID'] + Config.COUNT_COLS + Config.MEASURE_COLS
-    out_df = out_df[cols]
-    out_df.to_csv('submission.csv', index=False)
-    print("Submission saved to submission.csv")
+    return ResultWriter(output or args.output, cols, fsync_every=args.fsync_every, resume=args.resume)
+
+def run_pipeline(args, test_df, backend, writer, cache=None, progress=True):
+    """Stream the rows of ``test_df`` through tiling, ``backend`` and post-processing into ``writer``."""
+    from tqdm import tqdm
+
+    tile_size = backend.tile_size
+    if args.fast_tiles:
+        tile_fn = partial(load_tiles_vectorized, tile_size=tile_size)
+    else:
+        import albumentations as A
+        from albumentations.pytorch import ToTensorV2
+
+        transform = A.Compose([A.Resize(tile_size, tile_size), A.Normalize(), ToTensorV2()])
+        tile_fn = partial(load_tiles, transform=transform)
+    if args.tile_store:
+        from tile_store import TileStore
+        store = TileStore(args.tile_store)
+        store.check(tile_size, Config.GRID_ROWS, Config.GRID_COLS, 'fast' if args.fast_tiles else 'reference')
+        tile_fn = partial(load_tiles_stored, store=store, fallback=tile_fn)
+    load_fn = tile_fn
+
+    if cache is not None:
+        # Features depend on pixels, tiling and backbone weights, not on the rice type
+        ckpt_stat = os.stat(args.checkpoint)
+        tag = (Config.MODEL_NAME, os.path.abspath(args.checkpoint), ckpt_stat.st_size, ckpt_stat.st_mtime,
+               tile_size, Config.GRID_ROWS, Config.GRID_COLS, args.fast_tiles)
+        load_fn = partial(load_tiles_cached, load_fn=tile_fn, cache=cache, tag=tag)
+
+    # Tiles are produced in Test.csv order by background workers while the model runs
+    tile_stream = prefetch_map(load_fn, test_df['ID'].tolist(),
+                               num_workers=args.workers, depth=args.prefetch,
+                               use_processes=args.worker_processes)
+
+    with writer, tqdm(total=len(test_df), disable=not progress) as pbar:
+        for batch in iter_batches(test_df, args.batch_size):
+            rice_types = [rice_type_index(c) for c in batch['Comment']]
+            ids = batch['ID'].tolist()
+            with profiling.stage('wait_tiles', images=ids):
+                tiles = [next(tile_stream) for _ in range(len(batch))]
+            keys = None
+            if cache is not None:
+                keys, tiles = zip(*tiles)
+            p_c, p_m = backend.predict(list(tiles), rice_types, keys=keys,
+                                       reload=lambda i: tile_fn(batch['ID'].iloc[i]))
+            
+            with profiling.stage('postprocess', images=ids):
+                rows = [postprocess(image_id, p_c[i], p_m[i], rice_types[i], backend.m_stats)
+                        for i, image_id in enumerate(ids)]
+            with profiling.stage('write_rows', images=ids):
+                for row in rows:
+                    writer.write(row)
+            pbar.update(len(batch))
+
+def main(argv=None):
+    """Load checkpoint, run inference on test data, and write submission CSV."""
+    import pandas as pd
+
+    args = parse_args(argv)
+    profiler = profiling.enable() if args.profile else profiling.NULL_PROFILER
+    set_seed(Config.SEED)
+    test_df = pd.read_csv(Config.TEST_CSV)
+
+    writer = open_writer(args)
+    if writer.done_ids:
+        print(f"Resuming {args.output}: {len(writer.done_ids)} rows already written")
+        test_df = test_df[~test_df['ID'].astype(str).isin(writer.done_ids)]
+
+    cache = None
+    if args.feature_cache_mb > 0 or args.feature_cache_dir:
+        from feature_cache import FeatureCache
+        cache = FeatureCache(int(args.feature_cache_mb * 2**20), spill_dir=args.feature_cache_dir)
+    backend = create_backend(args, cache)
+    try:
+        run_pipeline(args, test_df, backend, writer, cache=cache)
+    finally:
+        if cache is not None:
+            cache.flush()   # features still in memory are reused by the next run from --feature-cache-dir
+
+    if cache is not None:
+        print(f"Feature cache: {cache.stats()}")
+    if getattr(backend, 'tile_filter', None) is not None:
+        print(f"Tile filter: {backend.tile_filter.stats()}")
+
+    print(f"Submission saved to {args.output}")
+
+    if profiler.enabled:
+        profiling.disable()
+        print()
+        profiler.print_summary(n_images=len(test_df))
+        if args.trace:
+            profiler.export_chrome_trace(args.trace)
+            print(f"Trace saved to {args.trace}")
 
 if __name__ == "__main__":
     main()
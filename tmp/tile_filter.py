@@ -0,0 +1,174 @@
+"""Background-tile pre-filter for sparse trays.
+
+When the rice is clustered in part of the tray, many of the 48 tiles are
+plain background but still go through the backbone and all count heads.
+TileFilter scores every tile with a cheap statistic, computed on a strided
+subsample of the already tiled batch (un-normalized back to 0..255):
+
+    foreground  fraction of pixels further than ``color_tol`` (any channel)
+                from the tray colour, taken as the median colour of the
+                image's flattest tile.  If even that tile is textured
+                (std > ``flat_std``: a full tray) every tile is kept.
+    std         standard deviation of the grey level inside the tile
+
+Tiles scoring below ``threshold`` are dropped from the backbone pass
+(UltimateSpecialist.forward ``tile_mask``): they contribute 0 to the count
+sums and the measure head averages the pooled features of the kept tiles
+only.  The highest-scoring tile of every image is always kept.
+
+Skipping tiles changes the outputs, so ``--report`` runs a labelled set
+(ID, Comment and the target columns, e.g. Train.csv) through the full and
+the filtered path and prints the skip rate, per-column MAE of both and the
+speed-up:
+
+    python tile_filter.py --report --labels Data/Train.csv --limit 64
+    python tile_filter.py --report --thresholds 0.001,0.005,0.02
+    python submit.py --tile-filter foreground --tile-filter-threshold 0.002
+"""
+
+import argparse
+import time
+
+import torch
+
+from submit import Config
+from tiling import NORM_MEAN, NORM_STD
+
+METHODS = ('foreground', 'std')
+DEFAULT_THRESHOLDS = {'foreground': 0.002, 'std': 4.0}
+
+
+class TileFilter:
+    """Keep mask (B, N) for batches of normalized (B, N, 3, T, T) tiles; counts kept/seen tiles."""
+
+    def __init__(self, method='foreground', threshold=None, color_tol=30.0, flat_std=12.0, stride=4):
+        if method not in METHODS:
+            raise ValueError(f"method must be one of {METHODS}, got {method!r}")
+        self.method = method
+        self.threshold = DEFAULT_THRESHOLDS[method] if threshold is None else threshold
+        self.color_tol = color_tol
+        self.flat_std = flat_std
+        self.stride = stride
+        self.kept = 0
+        self.total = 0
+
+    def scores(self, tiles):
+        """Per-tile statistic, (B, N) float."""
+        s = self.stride
+        std = torch.tensor(NORM_STD, device=tiles.device).view(3, 1, 1) * 255.0
+        mean = torch.tensor(NORM_MEAN, device=tiles.device).view(3, 1, 1) * 255.0
+        pix = tiles[..., ::s, ::s].float() * std + mean                # (B, N, 3, h, w) in 0..255
+        grey_std = pix.mean(dim=2).flatten(2).std(dim=-1)               # (B, N)
+        if self.method == 'std':
+            return grey_std
+
+        B = pix.shape[0]
+        flattest = grey_std.argmin(dim=1)
+        tray = pix[torch.arange(B), flattest].flatten(2).median(dim=-1).values   # (B, 3)
+        off_tray = (pix - tray.view(B, 1, 3, 1, 1)).abs().amax(dim=2) > self.color_tol
+        ratio = off_tray.float().mean(dim=(-2, -1))
+        full_tray = grey_std[torch.arange(B), flattest] > self.flat_std
+        ratio[full_tray] = 1.0
+        return ratio
+
+    def mask(self, tiles):
+        """Bool (B, N) mask of the tiles to run; at least one tile per image is kept."""
+        scores = self.scores(tiles)
+        keep = scores >= self.threshold
+        keep[torch.arange(len(keep)), scores.argmax(dim=1)] = True
+        self.kept += int(keep.sum())
+        self.total += keep.numel()
+        return keep
+
+    @property
+    def skip_rate(self):
+        return 1.0 - self.kept / self.total if self.total else 0.0
+
+    def stats(self):
+        return f"{self.method} >= {self.threshold:g}: skipped {self.total - self.kept}/{self.total} tiles ({self.skip_rate:.1%})"
+
+
+def _mae_table(labels, full, filtered):
+    """Per-column MAE of the full and filtered rows against ``labels`` (all DataFrames indexed by ID)."""
+    cols = [c for c in Config.COUNT_COLS + Config.MEASURE_COLS if c in labels.columns]
+    print(f"{'column':<22} {'MAE full':>10} {'MAE filtered':>13} {'delta':>9} {'|full-filtered|':>16}")
+    for col in cols:
+        a = (full[col] - labels[col]).abs().mean()
+        b = (filtered[col] - labels[col]).abs().mean()
+        print(f"{col:<22} {a:>10.4f} {b:>13.4f} {b - a:>+9.4f} {(full[col] - filtered[col]).abs().mean():>16.4f}")
+    if not cols:
+        print("no target columns in the labels file: showing agreement with the full path only")
+        for col in Config.COUNT_COLS + Config.MEASURE_COLS:
+            print(f"{col:<22} {'':>10} {'':>13} {'':>9} {(full[col] - filtered[col]).abs().mean():>16.4f}")
+
+
+def report(labels_df, model, m_stats, filters, batch_size, fast_tiles=False):
+    """Score ``labels_df`` with the full model and with every filter in ``filters``; print skip rate and MAE."""
+    import pandas as pd
+    from submit import build_meta, iter_batches, load_tiles, load_tiles_vectorized, postprocess, rice_type_index
+
+    if fast_tiles:
+        load = lambda i: load_tiles_vectorized(i, Config.TILE_SIZE)   # noqa: E731
+    else:
+        import albumentations as A
+        from albumentations.pytorch import ToTensorV2
+        transform = A.Compose([A.Resize(Config.TILE_SIZE, Config.TILE_SIZE), A.Normalize(), ToTensorV2()])
+        load = lambda i: load_tiles(i, transform)   # noqa: E731
+
+    rows = {'full': []} | {id(f): [] for f in filters}
+    seconds = {'full': 0.0} | {id(f): 0.0 for f in filters}
+    for batch in iter_batches(labels_df, batch_size):
+        rice_types = [rice_type_index(c) for c in batch['Comment']]
+        x = torch.stack([load(i) for i in batch['ID']])
+        meta = build_meta(rice_types)
+        for key, tile_filter in [('full', None)] + [(id(f), f) for f in filters]:
+            t0 = time.perf_counter()
+            with torch.no_grad():
+                mask = None if tile_filter is None else tile_filter.mask(x)
+                p_c, p_m = model(x, meta, tile_mask=mask)
+            seconds[key] += time.perf_counter() - t0
+            rows[key] += [postprocess(image_id, p_c[i].numpy(), p_m[i].numpy(), rice_types[i], m_stats)
+                          for i, image_id in enumerate(batch['ID'])]
+
+    labels = labels_df.set_index('ID')
+    full = pd.DataFrame(rows['full']).set_index('ID')
+    print(f"{len(labels_df)} images, full path {seconds['full']:.1f}s")
+    for f in filters:
+        filtered = pd.DataFrame(rows[id(f)]).set_index('ID')
+        print(f"\n{f.stats()}, {seconds[id(f)]:.1f}s ({seconds['full'] / seconds[id(f)]:.2f}x)")
+        _mae_table(labels, full, filtered)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Skip rate and accuracy impact of the background-tile filter')
+    parser.add_argument('--report', action='store_true', help='compare full and filtered outputs (the only action)')
+    parser.add_argument('--labels', default=Config.TRAIN_CSV,
+                        help='CSV with ID, Comment and target columns (images from Config.IMAGE_DIR)')
+    parser.add_argument('--limit', type=int, default=0, help='only use the first N rows')
+    parser.add_argument('--checkpoint', default=Config.CHECKPOINT)
+    parser.add_argument('--method', choices=METHODS, default='foreground')
+    parser.add_argument('--thresholds', help='comma-separated thresholds to compare (default: the method default)')
+    parser.add_argument('--batch-size', type=int, default=Config.BATCH_SIZE)
+    parser.add_argument('--fast-tiles', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.report:
+        parser.error('nothing to do, pass --report')
+    return args
+
+
+def main(argv=None):
+    import pandas as pd
+    from submit import load_model
+
+    args = parse_args(argv)
+    labels_df = pd.read_csv(args.labels)
+    if args.limit:
+        labels_df = labels_df.iloc[:args.limit]
+    thresholds = [float(t) for t in args.thresholds.split(',') if t] if args.thresholds else [None]
+    filters = [TileFilter(args.method, threshold=t) for t in thresholds]
+    model, m_stats = load_model(args.checkpoint)
+    report(labels_df, model, m_stats, filters, args.batch_size, fast_tiles=args.fast_tiles)
+
+
+if __name__ == '__main__':
+    main()
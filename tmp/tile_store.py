@@ -0,0 +1,196 @@
+"""Precomputed uint8 tile store for repeated evaluation runs.
+
+Re-scoring the same image set once per checkpoint / quantization variant /
+tile size used to decode, crop and resize every PNG again.  ``--build``
+does that once and writes all tiles into a single ``.npy`` array of shape
+(images, N_TILES, 3, T, T) uint8, plus a JSON index next to it:
+
+    ids        row order of the array (Test.csv IDs or image file stems)
+    tile_size, grid, tiler
+    sources    (size, mtime_ns) of each source image, to detect edits
+
+The tiles are stored *before* normalization, exactly as the chosen tiler
+produces them (``reference``: get_tiles + A.Resize per crop, ``fast``:
+tiling.tile_uint8).  TileStore maps the array copy-on-write, ``uint8()``
+returns zero-copy views and ``tiles()`` applies the same normalization as
+the live path, so a run from the store gives the same CSV as decoding.
+
+    python tile_store.py --out Data/tiles_512.npy                       # Test.csv, reference tiler
+    python tile_store.py --out Data/tiles_224.npy --tile-size 224 --image-dir Data/images/images
+    python submit.py --tile-store Data/tiles_512.npy
+"""
+
+import argparse
+import functools
+import json
+import os
+
+import numpy as np
+import torch
+
+from prefetch import prefetch_map
+
+TILERS = ('reference', 'fast')
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _source_stat(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def tile_uint8_reference(image, tile_size):
+    """(N, 3, T, T) uint8 tiles of the submit.load_tiles path, before A.Normalize."""
+    import albumentations as A
+    from submit import get_tiles
+
+    resize = A.Resize(tile_size, tile_size)
+    return np.stack([resize(image=t)['image'] for t in get_tiles(image)]).transpose(0, 3, 1, 2)
+
+
+@functools.lru_cache(maxsize=None)
+def reference_lut():
+    """(3, 256) float32 lookup table of A.Normalize() for uint8 input, taken from albumentations itself.
+
+    A.Normalize maps uint8 pixels through a per-channel LUT, so indexing this
+    table gives bit-identical results without the HWC round trip.
+    """
+    import albumentations as A
+
+    levels = np.repeat(np.arange(256, dtype=np.uint8)[:, None, None], 3, axis=2)   # (256, 1, 3) image
+    return np.ascontiguousarray(A.Normalize()(image=levels)['image'][:, 0, :].T)
+
+
+def _load_uint8(path, tile_size, grid_rows, grid_cols, tiler):
+    from PIL import Image
+
+    image = np.array(Image.open(path).convert('RGB'))
+    if tiler == 'fast':
+        from tiling import tile_uint8
+        return tile_uint8(image, tile_size, grid_rows, grid_cols).numpy()
+    return tile_uint8_reference(image, tile_size)
+
+
+def build(ids, paths, out_path, tile_size, grid_rows, grid_cols, tiler='reference', workers=2):
+    """Tile every image in ``paths`` into ``out_path``; row i holds ``ids[i]``."""
+    if tiler not in TILERS:
+        raise ValueError(f"tiler must be one of {TILERS}, got {tiler!r}")
+    n_tiles = grid_rows * grid_cols
+    tmp_path = out_path + '.tmp.npy'
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                      shape=(len(ids), n_tiles, 3, tile_size, tile_size))
+    load = lambda p: _load_uint8(p, tile_size, grid_rows, grid_cols, tiler)   # noqa: E731
+    for row, tiles in enumerate(prefetch_map(load, paths, num_workers=workers, depth=2 * max(workers, 1))):
+        array[row] = tiles
+    array.flush()
+    del array
+
+    index = {
+        'ids': [str(i) for i in ids],
+        'tile_size': tile_size,
+        'grid': [grid_rows, grid_cols],
+        'tiler': tiler,
+        'sources': [_source_stat(p) for p in paths],
+    }
+    with open(index_path(out_path) + '.tmp', 'w') as f:
+        json.dump(index, f)
+    # Array first, index last: a store with an index is always complete
+    os.replace(tmp_path, out_path)
+    os.replace(index_path(out_path) + '.tmp', index_path(out_path))
+    return out_path
+
+
+class TileStore:
+    """Read side of a tile store; picklable (workers reopen the mapping by path)."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(index_path(path)) as f:
+            index = json.load(f)
+        self.ids = index['ids']
+        self.tile_size = index['tile_size']
+        self.grid = tuple(index['grid'])
+        self.tiler = index['tiler']
+        self._sources = index['sources']
+        self._rows = {image_id: row for row, image_id in enumerate(self.ids)}
+        # copy-on-write: writable for torch.from_numpy, never written back
+        self.array = np.load(path, mmap_mode='c')
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, image_id):
+        return str(image_id) in self._rows
+
+    def check(self, tile_size, grid_rows, grid_cols, tiler):
+        """Raise ValueError if the store was built with a different tiling config."""
+        want = (tile_size, (grid_rows, grid_cols), tiler)
+        have = (self.tile_size, self.grid, self.tiler)
+        if want != have:
+            raise ValueError(f"{self.path} holds (tile_size, grid, tiler)={have}, this run needs {want}")
+
+    def is_fresh(self, image_id, source_path):
+        """True if ``image_id`` is stored and its source image has not changed since."""
+        row = self._rows.get(str(image_id))
+        return row is not None and os.path.exists(source_path) and _source_stat(source_path) == self._sources[row]
+
+    def uint8(self, image_id):
+        """Zero-copy (N, 3, T, T) uint8 view of the stored tiles."""
+        return self.array[self._rows[str(image_id)]]
+
+    def tiles(self, image_id):
+        """Normalized float32 (N, 3, T, T) tiles, identical to what the live tiler returns."""
+        u8 = torch.from_numpy(self.uint8(image_id))
+        if self.tiler == 'fast':
+            from tiling import normalize_tiles
+            return normalize_tiles(u8)
+        lut = reference_lut()
+        u8 = u8.numpy()
+        out = np.empty(u8.shape, dtype=np.float32)
+        for c in range(u8.shape[1]):
+            out[:, c] = lut[c][u8[:, c]]
+        return torch.from_numpy(out)
+
+
+def parse_args(argv=None):
+    from submit import Config
+
+    parser = argparse.ArgumentParser(description='Precompute uint8 tiles of an image set into a memory-mapped store')
+    parser.add_argument('--out', required=True, help='output .npy (the index is written next to it as .json)')
+    parser.add_argument('--csv', default=Config.TEST_CSV, help='take IDs from this CSV (images from Config.IMAGE_DIR)')
+    parser.add_argument('--image-dir', help='store every .png/.jpg in this directory instead, keyed by file stem')
+    parser.add_argument('--tile-size', type=int, default=Config.TILE_SIZE)
+    parser.add_argument('--fast-tiles', action='store_true', help='store tiles of the vectorized tiler (submit.py --fast-tiles)')
+    parser.add_argument('--workers', type=int, default=Config.NUM_WORKERS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from submit import Config, image_path
+
+    args = parse_args(argv)
+    if args.image_dir:
+        names = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+        ids = [os.path.splitext(f)[0] for f in names]
+        paths = [os.path.join(args.image_dir, f) for f in names]
+    else:
+        import pandas as pd
+        ids = pd.read_csv(args.csv)['ID'].tolist()
+        paths = [image_path(i) for i in ids]
+    tiler = 'fast' if args.fast_tiles else 'reference'
+    build(ids, paths, args.out, args.tile_size, Config.GRID_ROWS, Config.GRID_COLS, tiler=tiler, workers=args.workers)
+    mb = os.path.getsize(args.out) / 1e6
+    print(f"Stored {len(ids)} images ({tiler} tiler, {args.tile_size}px, {mb:.1f} MB) in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Vectorized tiling + normalization (same layout as the app's buildTileTensorNative).
+
+The reference path in submit.py slices the image into GRID_ROWS x GRID_COLS
+crops of uneven size, then resizes and normalizes every crop separately with
+albumentations and copies them again with ``torch.stack``.  Here the whole
+image is resized once to (GRID_ROWS*TILE, GRID_COLS*TILE), the tiles are a
+reshape/permute *view* of that buffer, and normalization is one batched op
+straight from uint8 into the output tensor.
+
+Parity with the reference (``get_tiles`` + ``A.Resize`` + ``A.Normalize``):
+    When the image height/width are multiples of GRID_ROWS/GRID_COLS both
+    paths use the same bilinear sampling grid.  Interior pixels then agree to
+    within one uint8 grey level after normalization (PARITY_INTERIOR_TOL;
+    OpenCV's fixed-point resize may round the two paths differently).  Near
+    the tile edges the per-tile resize clamps while the full-image resize
+    blends with the neighbouring tile.  When tiles are upscaled by ``s`` that
+    band is about s/2 output pixels wide (several grey levels apart at 512px
+    tiles from a 100px crop), so "interior" excludes interior_margin(s)
+    pixels on every side.  The mean absolute difference over all pixels is
+    bounded by PARITY_MEAN_TOL (normalized units).
+    For images that are not divisible, get_tiles gives the last row/column
+    the remainder pixels, so tile origins drift by up to remainder/grid
+    pixels.  Those images are reported but not held to the tolerances.
+
+    python tiling.py --check IMAGE [IMAGE ...]
+    python tiling.py --synthetic      # generated images, 64px and 512px tiles, no data needed
+"""
+
+import math
+
+import argparse
+
+import cv2
+import numpy as np
+import torch
+
+# A.Normalize() defaults (ImageNet), same values as NORM_MEAN/NORM_STD on mobile
+NORM_MEAN = (0.485, 0.456, 0.406)
+NORM_STD = (0.229, 0.224, 0.225)
+
+PARITY_INTERIOR_TOL = 1.0 / (255.0 * min(NORM_STD)) + 1e-6
+PARITY_MEAN_TOL = 0.01
+
+
+def tile_view(image, tile_size, grid_rows, grid_cols):
+    """Resize once and return a (grid_rows, grid_cols, 3, T, T) uint8 view of the tiles."""
+    full = cv2.resize(image, (grid_cols * tile_size, grid_rows * tile_size),
+                      interpolation=cv2.INTER_LINEAR)
+    full = torch.from_numpy(np.ascontiguousarray(full))
+    return full.view(grid_rows, tile_size, grid_cols, tile_size, 3).permute(0, 2, 4, 1, 3)
+
+
+def tile_uint8(image, tile_size, grid_rows, grid_cols):
+    """Contiguous (N, 3, T, T) uint8 tiles in row-major tile order."""
+    return tile_view(image, tile_size, grid_rows, grid_cols).reshape(
+        grid_rows * grid_cols, 3, tile_size, tile_size)
+
+
+def normalize_tiles(tiles):
+    """Normalize uint8 tiles of shape (..., 3, T, T) into a float32 (N, 3, T, T) tensor.
+
+    ``(x / 255 - mean) / std`` is folded into a single subtract/multiply with
+    the constants pre-scaled by 255, and the uint8 -> float conversion writes
+    directly into the (only) output buffer.
+    """
+    lead, (c, h, w) = tiles.shape[:-3], tiles.shape[-3:]
+    out = torch.empty((int(np.prod(lead)), c, h, w), dtype=torch.float32)
+    out.view(*lead, c, h, w).copy_(tiles)
+    mean = torch.tensor(NORM_MEAN, dtype=torch.float32).view(c, 1, 1) * 255.0
+    inv_std = 1.0 / (torch.tensor(NORM_STD, dtype=torch.float32).view(c, 1, 1) * 255.0)
+    return out.sub_(mean).mul_(inv_std)
+
+
+def tile_tensor(image, tile_size, grid_rows, grid_cols):
+    """Drop-in replacement for ``stack([transform(t) for t in get_tiles(image)])``."""
+    return normalize_tiles(tile_view(image, tile_size, grid_rows, grid_cols))
+
+
+def interior_margin(image_shape, tile_size, grid_rows, grid_cols):
+    """Pixels along each tile edge where the per-tile and full-image resize may blend different sources."""
+    h, w = image_shape[:2]
+    scale = max(tile_size * grid_rows / h, tile_size * grid_cols / w)
+    return max(1, math.ceil(scale / 2) + 1)
+
+
+def compare_with_reference(image, tile_size, grid_rows, grid_cols):
+    """Return (max_abs, mean_abs, interior_max_abs) between this tiler and the reference path.
+
+    The interior excludes interior_margin() pixels on each side of every tile.
+    """
+    import albumentations as A
+    from albumentations.pytorch import ToTensorV2
+    from submit import Config, get_tiles
+
+    assert (grid_rows, grid_cols) == (Config.GRID_ROWS, Config.GRID_COLS), 'get_tiles uses Config grid'
+    transform = A.Compose([A.Resize(tile_size, tile_size), A.Normalize(), ToTensorV2()])
+    ref = torch.stack([transform(image=t)['image'] for t in get_tiles(image)])
+    fast = tile_tensor(image, tile_size, grid_rows, grid_cols)
+    diff = (ref - fast).abs()
+    m = interior_margin(image.shape, tile_size, grid_rows, grid_cols)
+    return diff.max().item(), diff.mean().item(), diff[:, :, m:-m, m:-m].max().item()
+
+
+def check_parity(images, tile_size, grid_rows, grid_cols):
+    """Print parity stats for each (name, image); return False if a documented tolerance is exceeded."""
+    ok = True
+    for name, image in images:
+        h, w = image.shape[:2]
+        max_abs, mean_abs, interior = compare_with_reference(image, tile_size, grid_rows, grid_cols)
+        divisible = h % grid_rows == 0 and w % grid_cols == 0
+        passed = not divisible or (mean_abs <= PARITY_MEAN_TOL and interior <= PARITY_INTERIOR_TOL)
+        ok &= passed
+        margin = interior_margin(image.shape, tile_size, grid_rows, grid_cols)
+        print(f"{'OK  ' if passed else 'FAIL'} {name} ({w}x{h}, {tile_size}px tiles)  max={max_abs:.4f}  "
+              f"mean={mean_abs:.5f}  interior_max={interior:.2e} (margin {margin}px)"
+              f"{'' if divisible else '  (non-divisible, not checked)'}")
+    return ok
+
+
+def load_images(paths):
+    from PIL import Image
+
+    return [(path, np.array(Image.open(path).convert('RGB'))) for path in paths]
+
+
+# (width, height): divisible at several up/downscale factors, and two non-divisible sizes
+SYNTHETIC_SIZES = [(800, 600), (416, 300), (1600, 1200), (4000, 3000), (413, 301), (1001, 750)]
+
+
+def synthetic_images(sizes=SYNTHETIC_SIZES, seed=0):
+    """Tray-like test images: smooth blue background with bright grain-sized rectangles."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for w, h in sizes:
+        low = rng.integers(0, 256, (h // 40 + 2, w // 40 + 2, 3), dtype=np.uint8)
+        image = cv2.resize(low, (w, h), interpolation=cv2.INTER_CUBIC) // 4
+        image[..., 2] = np.maximum(image[..., 2], 160)
+        for _ in range(w * h // 4000):
+            y, x = rng.integers(0, h - 12), rng.integers(0, w - 20)
+            image[y:y + rng.integers(4, 12), x:x + rng.integers(8, 20)] = rng.integers(150, 256, 3)
+        images.append((f'synthetic_{w}x{h}', image))
+    return images
+
+
+if __name__ == '__main__':
+    from submit import Config
+
+    parser = argparse.ArgumentParser(description='Parity check of vectorized tiling against get_tiles + albumentations')
+    parser.add_argument('--check', nargs='+', metavar='IMAGE')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='check generated images (divisible and non-divisible) at 64px and 512px tiles')
+    parser.add_argument('--tile-size', type=int, default=Config.TILE_SIZE)
+    args = parser.parse_args()
+    if not (args.check or args.synthetic):
+        parser.error('pass --check IMAGE ... and/or --synthetic')
+    ok = True
+    if args.check:
+        ok &= check_parity(load_images(args.check), args.tile_size, Config.GRID_ROWS, Config.GRID_COLS)
+    if args.synthetic:
+        images = synthetic_images()
+        for tile_size in (64, 512):
+            ok &= check_parity(images, tile_size, Config.GRID_ROWS, Config.GRID_COLS)
+    raise SystemExit(0 if ok else 1)